@@ -0,0 +1,95 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# hands out unused image ids
+#
+
+import os
+import threading
+
+_allocators = {}
+_lock = threading.Lock()
+
+def image_id(filename):
+    """Returns the id of an image file named <id>.<ext>, or None."""
+    stem = filename.split('.', 1)[0]
+    return int(stem) if stem.isdigit() else None
+
+class IdAllocator():
+    """
+    Reserves ids for new images in a directory.
+
+    The ids taken by files in the directory are cached, and the directory is
+    only listed again when its modification time changes, instead of checking
+    each candidate name with a stat call. Reserved ids are remembered until
+    their files show up in the directory or they are released, so concurrent
+    downloads are never handed the same id even before their files are
+    written.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.dir_mtime = None
+        self.taken = set() # ids of files in the directory
+        self.reserved = set() # ids handed out by this allocator
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return
+        if dir_mtime == self.dir_mtime:
+            return
+        taken = set()
+        for filename in os.listdir(self.directory):
+            id = image_id(filename)
+            if id is not None:
+                taken.add(id)
+        self.taken = taken
+        self.reserved -= taken
+        self.dir_mtime = dir_mtime
+
+    def reserve(self, start, count=1):
+        """
+        Atomically reserves count unused ids, the lowest ones at or after
+        start, and returns them in increasing order.
+        """
+        with self.lock:
+            self._refresh()
+            ids = []
+            id = start
+            while len(ids) < count:
+                if id not in self.taken and id not in self.reserved:
+                    ids.append(id)
+                id += 1
+            self.reserved.update(ids)
+            return ids
+
+    def written(self, filename):
+        """
+        Records that this process wrote filename to the directory, so that
+        the change doesn't make the directory be listed again. The file's id,
+        if it has one, moves from the reserved ids to the taken ones.
+        """
+        with self.lock:
+            id = image_id(filename)
+            if id is not None:
+                self.reserved.discard(id)
+                self.taken.add(id)
+            if self.dir_mtime is not None:
+                try:
+                    self.dir_mtime = os.stat(self.directory).st_mtime
+                except OSError:
+                    pass
+
+    def release(self, ids):
+        """Gives back reserved ids whose files were never written."""
+        with self.lock:
+            self.reserved.difference_update(ids)
+
+def get_allocator(directory):
+    """Returns the allocator for directory, creating it on first use."""
+    with _lock:
+        allocator = _allocators.get(directory)
+        if allocator is None:
+            allocator = _allocators[directory] = IdAllocator(directory)
+        return allocator
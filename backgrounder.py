@@ -3,16 +3,26 @@
 # main file
 #
 
-import os
+import time
+_import_started = time.perf_counter()
+
 import sys
 import ctypes
+import random
+import signal
+import logs
+import threading
+import store
 import loader
-import download
-import win32event
-import win32service
-import servicemanager
-import win32serviceutil
-from data import Data
+
+# Only what a run needs to decide whether it has anything to do is imported
+# above. The download pipeline (requests, PIL, praw) is imported once a run is
+# due, the GUI only by the installer, and the Windows service modules only
+# when running as a service.
+IMPORT_TIME = time.perf_counter() - _import_started
+STARTUP_BUDGET = 0.05 # seconds a run may spend before it knows it's not due
+
+CONFIG_POLL = 60 # seconds between checks for changes to backgrounder.ini
 
 DEBUG = True
 
@@ -20,75 +30,203 @@ class Backgrounder():
     def __init__(self, dat):
         self._dat = dat
     
+    def configure_logging(self):
+        settings = self._dat.configdata['logging']
+        logs.configure(settings['file'], settings['max_bytes'], settings['backups'])
+    
     def get_timing_pref(self):
         return self._dat.configdata['timing']
     
-    def activate(self):
-        download.grab_images(self._dat)
-        loader.write_data(self._dat)
-
-class AppServerSvc (win32serviceutil.ServiceFramework):
-    """
-    Runs the script as a Windows service. Edited from the original to add 
-    functionality and flexibility.
+    def get_jitter_pref(self):
+        return self._dat.configdata['schedule']['jitter']
     
-    source https://stackoverflow.com/questions/32404/how-do-you-run-a-python-script-as-a-service-in-windows?rq=
-    """
-    _svc_name_ = "Backgrounder"
-    _svc_display_name_ = "Backgrounder"
-
-    def __init__(self, args):
-        win32serviceutil.ServiceFramework.__init__(self,args)
-        socket.setdefaulttimeout(60)
+    def get_period(self):
+        """Returns the number of seconds between the starts of two runs."""
+        return max(self.get_timing_pref(), loader.MIN_RUN_TIME)
+    
+    def time_until_due(self):
+        """
+        Returns the number of seconds until the next run is due, or 0 if it
+        is due now.
+        """
+        last = store.get_store().last_run()
+        if last is None:
+            return 0
+        started = last[0]
+        return max(0, started + self.get_period() - time.time())
+    
+    def activate(self):
+        import metrics
+        import download
+        metrics.reset()
+        started = time.time()
+        results = download.grab_images(self._dat)
+        saved = results.count(download.NO_ERROR)
+        with metrics.timer('state_write_seconds', data='save data'):
+            loader.write_data(self._dat, (started, time.time(), len(results), saved))
         
-        self._hWaitStop = win32event.CreateEvent(None,0,0,None)
-
-    def SvcStop(self):
-        self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
-        win32event.SetEvent(self._hWaitStop)
-
-    def SvcDoRun(self):
-        servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
-                              servicemanager.PYS_SERVICE_STARTED,
-                              (self._svc_name_,''))
-                
-        rc = None
-        while rc != win32event.WAIT_OBJECT_0:
-            # run, then wait
-            wait = run()
-            rc = win32event.WaitForSingleObject(self.hWaitStop, wait)
+        metrics.gauge('run_seconds', time.time() - started)
+        settings = self._dat.configdata['metrics']
+        try:
+            metrics.export(settings['prometheus_file'], settings['summary_file'])
+        except OSError as e:
+            logs.get_logger().warning(
+                'could not write metrics: %r' % e)
         
 def is_admin():
     try:
         return ctypes.windll.shell32.IsUserAnAdmin()
     except:
         return False
+
+class Scheduler():
+    """
+    Runs the program in a long-running process, starting a run whenever one
+    is due.
+    
+    The save data, settings, hash index, HTTP connection pools and Reddit
+    client are loaded once and kept between runs, so each run only does the
+    network work. The settings are reloaded when backgrounder.ini changes or
+    on SIGHUP. A random delay of up to the configured jitter is added to every
+    wait. SIGTERM and SIGINT stop the scheduler once the current run, if any,
+    is finished. Runs are started from a single loop, so two of them never
+    overlap.
+    """
+    def __init__(self):
+        self.backgrounder = None
+        self.stopping = False
+        self.reloading = False
+        self.rejected = None # stamp of an ini file that failed to load
+        self.wake = threading.Event()
+    
+    def stop(self, signum=None, frame=None):
+        self.stopping = True
+        self.wake.set()
+    
+    def reload(self, signum=None, frame=None):
+        self.reloading = True
+        self.wake.set()
+    
+    def install_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.reload)
+    
+    def load(self):
+        """
+        (Re)loads the save data and settings. Returns False on failure. If
+        backgrounder.ini is invalid, the settings loaded before are kept,
+        and only if there are none is that a failure.
+        """
+        self.reloading = False
+        try:
+            dat = loader.read_data(DEBUG, interactive=False)
+        except loader.ConfigError as e:
+            self.rejected = loader.config_stamp()
+            message = '%s; %s' % (e, 'keeping the previous settings'
+                                  if self.backgrounder is not None else 'stopping')
+            if DEBUG:
+                print(message)
+            logs.get_logger().error(message)
+            return self.backgrounder is not None
+        self.rejected = None
+        if dat is None:
+            return False
+        self.backgrounder = Backgrounder(dat)
+        self.backgrounder.configure_logging()
+        return True
     
-def run():
+    def jitter(self):
+        return random.uniform(0, self.backgrounder.get_jitter_pref())
+    
+    def serve(self):
+        """Runs until stopped."""
+        self.install_handlers()
+        if not self.load():
+            return
+        report_startup(time.perf_counter() - _import_started)
+        
+        due = time.time() + self.backgrounder.time_until_due() + self.jitter()
+        while True:
+            # cleared before the flags are read, so a signal arriving from
+            # here on still cuts the wait below short
+            self.wake.clear()
+            if self.stopping:
+                break
+            if self.reloading or (loader.config_changed() and
+                                  loader.config_stamp() != self.rejected):
+                report('reloading settings')
+                if not self.load():
+                    return
+                due = time.time() + self.backgrounder.time_until_due() + self.jitter()
+            
+            wait = due - time.time()
+            if wait > 0:
+                self.wake.wait(min(wait, CONFIG_POLL))
+                continue
+            
+            # the next run is scheduled from this one's start, even if it fails
+            started = time.time()
+            try:
+                self.backgrounder.activate()
+            except Exception:
+                logs.get_logger().exception('run failed')
+            due = started + self.backgrounder.get_period() + self.jitter()
+        
+        report('stopped')
+
+def report(message):
+    """Logs a message about the program itself, and prints it when debugging."""
+    if DEBUG:
+        print(message)
+    logs.get_logger().info(message)
+
+def report_startup(startup_time):
+    """Reports how long it took to start up and decide what to do."""
+    message = 'imports took %.1f ms, startup took %.1f ms' % (
+        IMPORT_TIME * 1000, startup_time * 1000)
+    if startup_time > STARTUP_BUDGET:
+        message += ' (over the budget of %.0f ms)' % (STARTUP_BUDGET * 1000)
+    report(message)
+    
+def run(force=False):
     """
     Main function. If there is no save data, run the loader and generate save 
-    data.
+    data. Returns the number of seconds until the next run is due.
+    
+    Unless force is set, nothing is downloaded if the last run started less
+    than the configured time ago. That check only needs the store, so a
+    scheduled run with nothing to do returns without importing the download
+    pipeline.
     """
     # request admin and rerun if not admin
 
-    
+    started = time.perf_counter()
     dat = loader.read_data(DEBUG)
     if dat is None:
         return
     
     backgrounder = Backgrounder(dat)
+    backgrounder.configure_logging()
+    wait = 0 if force else backgrounder.time_until_due()
+    report_startup(time.perf_counter() - started + IMPORT_TIME)
+    if wait > 0:
+        return wait
+    
     backgrounder.activate()
     
-    return backgrounder.get_timing_pref()
+    return backgrounder.get_period()
 
 if __name__ == '__main__':
-    if DEBUG:
-        run()
+    # lets the image check processes start from the packaged executable
+    import multiprocessing
+    multiprocessing.freeze_support()
+    
+    if '--daemon' in sys.argv:
+        Scheduler().serve()
+    elif DEBUG:
+        run(force='--force' in sys.argv)
     else:
-        # TODO : https://mail.python.org/pipermail/python-win32/2010-July/010648.html
-        if len(sys.argv) == 1:
-            servicemanager.Initialize()
-            servicemanager.PrepareToHostSingle(AppServerSvc)
-            servicemanager.StartServiceCtrlDispatcher()
-        else:
-            win32serviceutil.HandleCommandLine(AppServerSvc)
+        import service
+        service.main(sys.argv)
@@ -0,0 +1,129 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# memory-mapped bloom filters, used in front of the store's membership checks
+#
+
+import os
+import mmap
+import math
+import struct
+import hashlib
+
+MAGIC = b'BGBLOOM1'
+# magic, number of bits, number of hashes, capacity, error rate, count
+HEADER = struct.Struct('<8sQQQdQ')
+
+def optimal_size(capacity, error_rate):
+    """
+    Returns the (bits, hashes) a filter needs to hold capacity keys with the
+    given false-positive rate.
+    """
+    bits = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    hashes = max(1, int(round(bits / float(capacity) * math.log(2))))
+    return bits, hashes
+
+class BloomFilter():
+    """
+    Probabilistic set of strings persisted in a file.
+
+    A key that was added is always reported as present; a key that wasn't is
+    reported as present with a probability of about error_rate, as long as no
+    more than capacity keys were added. The file is memory-mapped, so opening
+    a filter reads nothing up front and adding a key only touches a few bytes.
+    """
+    def __init__(self, filename):
+        """Opens the filter stored in filename."""
+        self.filename = filename
+        self.file = open(filename, 'r+b')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0)
+        except (ValueError, OSError):
+            self.file.close()
+            raise
+        magic, self.bits, self.hashes, self.capacity, self.error_rate, \
+            self.count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or \
+                len(self.map) < HEADER.size + (self.bits + 7) // 8:
+            self.close()
+            raise ValueError('%s is not a bloom filter' % filename)
+
+    @staticmethod
+    def create(filename, capacity, error_rate, keys=()):
+        """
+        Writes a new filter holding keys to filename, replacing any filter
+        that was there, and returns it opened.
+        """
+        bits, hashes = optimal_size(capacity, error_rate)
+        tmp = filename + '.tmp'
+        with open(tmp, 'wb') as out:
+            out.write(HEADER.pack(MAGIC, bits, hashes, capacity, error_rate, 0))
+            out.truncate(HEADER.size + (bits + 7) // 8)
+        os.replace(tmp, filename)
+
+        bloom = BloomFilter(filename)
+        for key in keys:
+            bloom.add(key)
+        bloom.flush()
+        return bloom
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.map[HEADER.size + position // 8] & (1 << (position % 8)):
+                return False
+        return True
+
+    def add(self, key):
+        """Adds key to the filter."""
+        added = False
+        for position in self._positions(key):
+            offset = HEADER.size + position // 8
+            byte = self.map[offset]
+            if not byte & (1 << (position % 8)):
+                self.map[offset] = byte | (1 << (position % 8))
+                added = True
+        if added:
+            self.count += 1
+            HEADER.pack_into(self.map, 0, MAGIC, self.bits, self.hashes,
+                             self.capacity, self.error_rate, self.count)
+
+    def is_full(self):
+        """Returns True once the filter holds more keys than it was sized for."""
+        return self.count > self.capacity
+
+    def flush(self):
+        """Makes sure every key added so far is written to the file."""
+        self.map.flush()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+def open_filter(filename, capacity, error_rate, keys):
+    """
+    Opens the filter stored in filename. It is rebuilt from keys(), the exact
+    set of keys, if it is missing or unreadable, was built for a different
+    error rate, or holds more keys than it was sized for. A rebuilt filter is
+    made large enough for twice the keys it holds.
+    """
+    bloom = None
+    if os.path.isfile(filename):
+        try:
+            bloom = BloomFilter(filename)
+        except (OSError, ValueError, struct.error):
+            bloom = None
+    if bloom is not None and bloom.error_rate == error_rate and \
+            not bloom.is_full():
+        return bloom
+
+    if bloom is not None:
+        capacity = max(capacity, bloom.count * 2)
+        bloom.close()
+    keys = list(keys())
+    capacity = max(capacity, len(keys) * 2)
+    return BloomFilter.create(filename, capacity, error_rate, keys)
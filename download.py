@@ -4,37 +4,61 @@
 #
 
 import os
+import re
+import time
 import random
-import logging
 import datetime
-import requests
-from PIL import Image
-from reddit import Reddit
-from PIL import ImageChops
+import logs
+import metrics
+import threading
+import seen
+import store
+import hashindex
+import imagehead
+import allocator
+import pipeline
+import imagecheck
+import httpclient
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from imgur_album_downloader.imguralbum import ImgurAlbumDownloader
 
 NO_ERROR = 0
 ERR_NOT_IMAGE = 1
 ERR_DUPLICATE_IMAGE = 2
 ERR_DUPLICATE_GALLERY = 3
+ERR_WRONG_SIZE = 4
+ERR_SEEN_POST = 5
+ERR_DOWNLOAD_FAILED = 6
 
-def get_logger():
-    """Initializes and returns the logging object."""
-    logger = logging.getLogger('backgrounder')
-    logger.setLevel(logging.INFO)
+# how result codes are labeled in the metrics
+RESULT_NAMES = {
+    NO_ERROR : 'no_error',
+    ERR_NOT_IMAGE : 'not_image',
+    ERR_DUPLICATE_IMAGE : 'duplicate_image',
+    ERR_DUPLICATE_GALLERY : 'duplicate_gallery',
+    ERR_WRONG_SIZE : 'wrong_size',
+    ERR_SEEN_POST : 'seen_post',
+    ERR_DOWNLOAD_FAILED : 'download_failed',
+}
 
-    fh = logging.FileHandler('backgrounder.log')
-    fh.setLevel(logging.INFO)
+ALBUM_CACHE_DIR = 'album_cache'
+# imgur albums and galleries; direct links to i.imgur.com are plain images
+GALLERY_URL = re.compile(r'^https?://(?:www\.)?(?:m\.)?imgur\.com/(?:a|gallery)/[a-zA-Z0-9]+')
 
-    logger.addHandler(fh)
+LISTING_WORKERS = 8
+LISTING_TIMEOUT = 30 # seconds
+LISTING_POLL = 0.5 # seconds between checks for listings that timed out
+
+# guards save data and the hash index while posts download concurrently
+_lock = threading.Lock()
 
-    return logger
-    
 def is_image(image_path):
     """
     Checks if an image can be opened. If it can't, that usually means that the
-    original post did not contain an image.
+    original post did not contain an image. image_path may also be a file
+    object.
     """
+    from PIL import Image
     try:
         Image.open(image_path)
     except OSError:
@@ -42,12 +66,90 @@ def is_image(image_path):
         return False
     return True
     
+def content_size(headers):
+    """
+    Returns the full size of a response's content in bytes, or None if the
+    headers don't say. Resumed downloads report it in their Content-Range.
+    """
+    content_range = headers.get('Content-Range', '')
+    if '/' in content_range and not content_range.endswith('*'):
+        return int(content_range.rsplit('/', 1)[1])
+    length = headers.get('Content-Length')
+    return int(length) if length is not None else None
+
+def fits_filters(filters, width=None, height=None, size=None):
+    """
+    Checks an image against the user's size filters. Anything passed as None
+    isn't checked, and limits set to 0 aren't enforced.
+    
+    Arguments:
+        filters -- the 'filter' section of the config
+        width, height -- the dimensions of the image in pixels
+        size -- the size of the image file in bytes
+    """
+    if size is not None:
+        if filters['min_bytes'] and size < filters['min_bytes']:
+            return False
+        if filters['max_bytes'] and size > filters['max_bytes']:
+            return False
+    
+    if width is None or height is None:
+        return True
+    if filters['min_width'] and width < filters['min_width']:
+        return False
+    if filters['max_width'] and width > filters['max_width']:
+        return False
+    if filters['min_height'] and height < filters['min_height']:
+        return False
+    if filters['max_height'] and height > filters['max_height']:
+        return False
+    
+    aspect = width / float(height) if height else 0
+    if filters['min_aspect'] and aspect < filters['min_aspect']:
+        return False
+    if filters['max_aspect'] and aspect > filters['max_aspect']:
+        return False
+    return True
+
+def image_inspector(filters):
+    """
+    Returns an inspect callback for httpclient.download_part that rejects a
+    download as soon as its headers or first bytes show that it isn't an image,
+    or that it doesn't fit the size filters, so the rest of it is never
+    transferred.
+    """
+    def inspect(headers, head):
+        if not imagehead.is_image_type(headers.get('Content-Type', '')):
+            raise httpclient.Rejected(ERR_NOT_IMAGE)
+        if not fits_filters(filters, size=content_size(headers)):
+            raise httpclient.Rejected(ERR_WRONG_SIZE)
+        
+        if len(head) < imagehead.SNIFF_SIZE:
+            return False
+        if imagehead.sniff(head) is None:
+            raise httpclient.Rejected(ERR_NOT_IMAGE)
+        
+        dimensions = imagehead.dimensions(head)
+        if dimensions is None:
+            # header isn't complete yet
+            return False
+        if not fits_filters(filters, *dimensions):
+            raise httpclient.Rejected(ERR_WRONG_SIZE)
+        return True
+    
+    return inspect
+
 def is_duplicate(image_path, filepath):
     """
     Checks if the given image is a duplicate of any existing image in the 
     specified directory (normally where the user has chosen backgrounds to be 
     stored).
     
+    The check is a lookup in the directory's perceptual-hash index rather than
+    a comparison against every stored image, so it also catches re-encoded or
+    resized copies of an image. Flat images, whose hash can't tell them apart,
+    only count as duplicates of exact copies.
+    
     Arguments:
         image_path -- the absolute path to the image in question
         filepath -- the directory to inspect
@@ -55,30 +157,16 @@ def is_duplicate(image_path, filepath):
         True -- the image specified by image_path is a duplicate
         False -- the image specified by image_path isn't a duplicate
     """
-    BLOCKSIZE = 65536
+    index = hashindex.get_index(filepath)
+    value, width, height = hashindex.describe(image_path)
+    if not hashindex.is_conclusive(value):
+        digest = httpclient.new_digest()
+        with open(image_path, 'rb') as input:
+            digest.update(input.read())
+        return index.has_digest(digest.hexdigest(), os.path.basename(image_path))
+    match = index.find(value, width, height, os.path.basename(image_path))
     
-    im1 = Image.open(image_path)
-    
-    for filename in os.listdir(filepath):
-        if filename.endswith('.png') or filename.endswith('.jpg'):
-            full_path = filepath + '/' + filename
-            if full_path == image_path:
-                # don't compare the image to itself
-                continue
-            
-            im2 = Image.open(full_path)
-            
-            try:
-                diff = ImageChops.difference(im1, im2).getbbox()
-                if not diff:
-                    # boundary box doesn't exist -- images are identical
-                    return True
-                
-            except ValueError:
-                # images aren't of the same dimension
-                continue
-            
-    return False
+    return match is not None
 
 def download_imgur(url, dat):
     """
@@ -88,78 +176,303 @@ def download_imgur(url, dat):
     Arguments:
         url -- the url of the imgur gallery
     Returns:
-        True -- operation successfully completed
-        False -- there was an error
+        the result code of the gallery; see album_result
     """
     # if ignoring duplicates, don't download from the same gallery twice
-    if dat.configdata['other']['ignore_duplicates'] == 1:
-        if url in dat.userdata['imgur_galleries']:
-            return ERR_DUPLICATE_GALLERY
+    # (mark it as visited right away so concurrent posts don't both fetch it)
+    with _lock:
+        if dat.configdata['other']['ignore_duplicates'] == 1:
+            if url in dat.userdata['imgur_galleries']:
+                return ERR_DUPLICATE_GALLERY
+        dat.userdata['imgur_galleries'].add(url)
     
-    downloader = ImgurAlbumDownloader(url)
-    path = dat.configdata['path']['image']
-    idx = random.randint(1, downloader.num_images() + 1)
+    try:
+        inspect = image_inspector(dat.configdata['filter'])
+        describe = dat.configdata['other']['ignore_duplicates'] == 1
+        def retrieve(image_url, image_path):
+            with metrics.timer('transfer_seconds', kind='album'):
+                digest = httpclient.retrieve(image_url, image_path, inspect)
+            note_written(dat, image_path)
+            metrics.count('transfer_bytes_total', os.path.getsize(image_path),
+                          kind='album')
+            if describe:
+                index_image(dat, image_path, digest)
+        
+        # a single random image only needs the page read up to that image
+        random_image = dat.configdata['other']['download_gallery'] == 0
+        with metrics.timer('album_page_seconds'):
+            downloader = ImgurAlbumDownloader(url, httpclient.get_session(),
+                                              retrieve, ALBUM_CACHE_DIR,
+                                              random_image)
+        cached = downloader.response is not False and \
+                 downloader.response.status_code == 304
+        metrics.count('album_cache_total', result='hit' if cached else 'miss')
+        path = dat.configdata['path']['image']
+        workers = dat.configdata['download']['album_workers']
 
-    if dat.configdata['other']['download_gallery'] == 0:
-        # download a random image
-        downloader.save(path, idx)
-    else:
-        # download entire gallery
-        downloader.save(path)
+        if random_image:
+            # download a random image
+            outcomes = downloader.save(path, downloader.chosen_index(), workers)
+        else:
+            # download entire gallery
+            outcomes = downloader.save(path, workers=workers)
+    except:
+        with _lock:
+            dat.userdata['imgur_galleries'].discard(url)
+        raise
+    
+    log = logs.get_logger()
+    for image_path, error in outcomes:
+        if error is not None and not isinstance(error, httpclient.Rejected):
+            log.warning('could not download %s: %r' % (image_path, error),
+                        extra={'url' : url, 'path' : image_path})
+    
+    result = album_result([error for (image_path, error) in outcomes])
+    if result != NO_ERROR:
+        # nothing was saved, so the gallery may be tried again
+        with _lock:
+            dat.userdata['imgur_galleries'].discard(url)
+    return result
+
+def image_index(dat, sync=True):
+    """
+    Returns the hash index of the image directory. Images that are new to
+    it are hashed in the worker processes first, and _lock is only taken to
+    update the index, so _lock must not be held when calling this.
+    """
+    return hashindex.get_index(dat.configdata['path']['image'], sync, _lock,
+                               dat.configdata['download']['check_workers'])
+
+def index_image(dat, path, digest):
+    """
+    Adds an image saved to the image directory by other means than
+    store_candidate, such as an album image, to the hash index, so the
+    directory doesn't have to be listed again to find it.
+    """
+    checked = imagecheck.run_check(path, True,
+                                   dat.configdata['download']['check_workers'])
+    if checked is None:
+        return
+    width, height, value = checked
+    index = image_index(dat, sync=False)
+    with _lock:
+        index.add(path, digest, value, width, height)
+
+def album_result(errors):
+    """
+    Returns the result code of a gallery, given what went wrong with each of
+    the images that were to be saved from it (None for every image saved).
+    The gallery succeeded if any image was saved. Otherwise, if any download
+    failed the gallery is reported as failed, so it is tried again; else the
+    reason the images were rejected is reported.
+    """
+    if not errors:
+        return ERR_NOT_IMAGE
+    if any(error is None for error in errors):
+        return NO_ERROR
     
-    dat.userdata['imgur_galleries'].add(url)
+    rejected = [error.args[0] for error in errors
+                if isinstance(error, httpclient.Rejected)]
+    if len(rejected) < len(errors):
+        return ERR_DOWNLOAD_FAILED
+    return ERR_WRONG_SIZE if ERR_WRONG_SIZE in rejected else ERR_NOT_IMAGE
+
+class Candidate(pipeline.Item):
+    """A post, or just the url of an image, on its way to the image directory."""
+    def __init__(self, url, post=None):
+        super().__init__()
+        self.url = url
+        self.post = post
+        self.gallery = GALLERY_URL.match(url) is not None
+        self.path = None # where the image is stored if it's kept
+        self.part = None # temp file holding the download
+        self.lock = None # held while working on the temp file
+        self.digest = None # hex content digest of the download
+        self.bytes = None # size of the download
+        self.started = time.time()
+        self.description = None # (hash, width, height) of the image
+
+def filter_candidate(candidate, dat, batch):
+    """
+    Skips posts whose media was already processed, without requesting it,
+    and reserves a path for the image of every other post.
+    
+    Arguments:
+        batch -- canonical urls of the posts let through so far; see seen.is_seen
+    """
+    if dat.configdata['other']['ignore_duplicates'] == 1 and \
+            candidate.post is not None:
+        if seen.is_seen(candidate.post, store.get_store(), batch):
+            metrics.count('seen_cache_total', result='hit')
+            candidate.result = ERR_SEEN_POST
+            return
+        metrics.count('seen_cache_total', result='miss')
+    
+    if not candidate.gallery:
+        with _lock:
+            candidate.path = reserve_paths(dat, 1)[0]
+
+def fetch_candidate(candidate, dat):
+    """
+    Downloads the media of a candidate. A gallery is downloaded completely
+    right here; an image is downloaded to a temp file in the image directory's
+    .partial subdirectory, and a content digest is computed while it streams
+    in. The transfer is cancelled as soon as the response turns out not to be
+    an image, or not to fit the user's size filters.
     
-    return NO_ERROR
+    The temp file stays locked until the candidate is finished; see
+    finish_candidate.
+    """
+    if candidate.gallery:
+        candidate.result = download_imgur(candidate.url, dat)
+        return
+    
+    part = httpclient.part_path(candidate.url, dat.configdata['path']['image'])
+    lock = httpclient.part_lock(part)
+    lock.acquire()
+    candidate.part = part
+    candidate.lock = lock
+    try:
+        inspect = image_inspector(dat.configdata['filter'])
+        with metrics.timer('transfer_seconds', kind='image'):
+            candidate.digest = httpclient.download_part(candidate.url, part,
+                                                        inspect)
+    except httpclient.Rejected as e:
+        candidate.result = e.args[0]
+        return
+    candidate.bytes = os.path.getsize(part)
+    metrics.count('transfer_bytes_total', candidate.bytes, kind='image')
+
+def validate_candidate(candidate, dat):
+    """
+    Checks that a download is a complete image that fits the size filters,
+    and describes it for dedupe_candidate if duplicates are ignored. The
+    image is decoded by a worker process; see imagecheck. Exact copies of a
+    stored image are rejected by their digest first, without decoding them.
+    """
+    part = candidate.part
+    describe = dat.configdata['other']['ignore_duplicates'] == 1
+    if describe:
+        index = image_index(dat)
+        with _lock:
+            duplicate = index.has_digest(candidate.digest)
+        if duplicate:
+            httpclient.discard_part(part)
+            candidate.result = ERR_DUPLICATE_IMAGE
+            return
+    
+    checked = imagecheck.run_check(part, describe,
+                                   dat.configdata['download']['check_workers'])
+    
+    # check to make sure the image is an image, and all of it arrived intact
+    if checked is None:
+        httpclient.discard_part(part)
+        candidate.result = ERR_NOT_IMAGE
+        return
+    
+    # formats whose header couldn't be read while downloading are checked here
+    width, height, value = checked
+    if not fits_filters(dat.configdata['filter'], width, height,
+                        os.path.getsize(part)):
+        httpclient.discard_part(part)
+        candidate.result = ERR_WRONG_SIZE
+        return
+    
+    if describe:
+        candidate.description = (value, width, height)
+
+def dedupe_candidate(candidate, dat):
+    """
+    Checks that an image doesn't look the same as a stored image, if
+    duplicates are ignored, by the perceptual hash validate_candidate
+    computed. Exact copies were already caught by validate_candidate.
+    """
+    if dat.configdata['other']['ignore_duplicates'] != 1:
+        return
+    
+    index = image_index(dat)
+    with _lock:
+        duplicate = index.find(*candidate.description) is not None
+    
+    if duplicate:
+        httpclient.discard_part(candidate.part)
+        candidate.result = ERR_DUPLICATE_IMAGE
+
+def commit_candidate(candidate, dat):
+    """
+    Moves a checked download to its path. If a file showed up there in the
+    meantime, e.g. one the user copied into the image directory, another path
+    is reserved instead of replacing it. _lock must be held.
+    """
+    while True:
+        try:
+            httpclient.commit_part(candidate.part, candidate.path)
+            break
+        except FileExistsError:
+            note_written(dat, candidate.path) # the id is taken after all
+            candidate.path = reserve_paths(dat, 1)[0]
+    note_written(dat, candidate.path)
+
+def store_candidate(candidate, dat):
+    """Moves a checked download to its path and adds it to the hash index."""
+    if dat.configdata['other']['ignore_duplicates'] != 1:
+        with _lock:
+            commit_candidate(candidate, dat)
+        candidate.result = NO_ERROR
+        return
     
+    index = image_index(dat)
+    with _lock:
+        # check again, another worker may have stored the same image meanwhile
+        if index.has_digest(candidate.digest) or \
+                index.find(*candidate.description) is not None:
+            httpclient.discard_part(candidate.part)
+            candidate.result = ERR_DUPLICATE_IMAGE
+            return
+        
+        commit_candidate(candidate, dat)
+        index.add(candidate.path, candidate.digest, *candidate.description)
+    candidate.result = NO_ERROR
+
+IMAGE_STEPS = (fetch_candidate, validate_candidate, dedupe_candidate,
+               store_candidate)
+
 def download_image(id, url, dat):
     """
     Retrieves an image and stores it to disk.
+    
+    The image goes through the same steps as in grab_images, just one after
+    the other: the temp file is only moved to id once it is complete, is a
+    valid image and isn't a duplicate, so an interrupted download never leaves
+    a truncated image behind, and is resumed where it left off the next time
+    the same url comes up.
 
     Arguments:
-        id -- The next id to use for an image to download
+        id -- The path to store the image at
         url -- The URL of the image to retrieve
     
     Returns:
-    True -- image was downloaded
-    False  -- image was not downloaded
-    """
-	# TODO: If download fails, close program gracefully and log stack traces
-	
-    with open(id, 'wb') as handle:
-        response = requests.get(url, stream=True)
-
-        if not response.ok:
-            print(response)
-            raise Exception(
-                    'There was an issue downloading the image. ' +
-                    'Please double-check your internet connection.'
-                )
-
-        for block in response.iter_content(1024):
-            if not block:
+        the result code of the download
+    """
+    candidate = Candidate(url)
+    candidate.gallery = False
+    candidate.path = id
+    try:
+        for step in IMAGE_STEPS:
+            step(candidate, dat)
+            if candidate.result is not None:
                 break
-
-            handle.write(block)
-    
-    # check to make sure the image is an image
-    if not is_image(id):
-        os.remove(id)
-        return ERR_NOT_IMAGE
-    
-    # check to make sure the image isn't a duplicate, if necessary
-    if dat.configdata['other']['ignore_duplicates'] == 1:
-        if is_duplicate(id, dat.configdata['path']['image']):
-            os.remove(id)
-            return ERR_DUPLICATE_IMAGE
-    
-    return NO_ERROR
+    finally:
+        if candidate.lock is not None:
+            candidate.lock.release()
+    return candidate.result
 
 def combine_paths(dat, increment=0):
     """
     Determines the precise location where the new image will be written.
 
     This procedure takes the user-specified file path where images will be
-    stored and searches for an unused filename based on the last-used filename
+    stored and reserves an unused filename based on the last-used filename
     in the save data. This is to avoid overwriting images.
 
     Arguments:
@@ -168,109 +481,287 @@ def combine_paths(dat, increment=0):
     Returns:
         a viable path for the new image
     """
+    return reserve_paths(dat, 1, increment)[0]
+
+def reserve_paths(dat, count, increment=0):
+    """
+    Reserves count unused image paths at once, e.g. one for each post that is
+    about to be downloaded. Ids are handed out by the directory's allocator,
+    which never probes the disk for each candidate name.
+
+    Arguments:
+        dat -- save data
+        count -- number of paths to reserve
+        increment -- allows the first id to be increased
+    Returns:
+        a list of count viable paths
+    """
+    if count == 0:
+        return []
     path = dat.configdata['path']['image']
-    image_id = dat.userdata['image_id'] + increment
-    image_ext = "/" + str(image_id) + ".png"
-    # loop through different extensions to avoid overwriting images
-    while os.path.isfile(path + image_ext):
-        image_id += 1
-        image_ext = "/" + str(image_id) + ".png"
-    dat.userdata['image_id'] = image_id
-    return path + image_ext
-
-def topmost_post(subreddits):
+    start = dat.userdata['image_id'] + increment
+    ids = allocator.get_allocator(path).reserve(start, count)
+    dat.userdata['image_id'] = ids[-1] + 1
+    return [path + "/" + str(image_id) + ".png" for image_id in ids]
+
+def note_written(dat, path):
+    """
+    Tells the image directory's allocator about a file written to it, so it
+    doesn't list the directory again.
+    """
+    allocator.get_allocator(dat.configdata['path']['image']).written(
+        os.path.basename(path))
+
+def release_paths(dat, paths):
+    """Gives back paths from reserve_paths that no image was stored at."""
+    ids = [allocator.image_id(os.path.basename(path)) for path in paths]
+    allocator.get_allocator(dat.configdata['path']['image']).release(ids)
+
+def top_of_day(subreddit, limit=1):
+    """Returns the top posts of the day of a subreddit, as a list."""
+    # WARN : If the subreddit has low activity, this function may fail
+    return list(subreddit.top(time_filter='day', limit=limit))
+
+def iter_top_posts(subreddits, workers=LISTING_WORKERS, timeout=LISTING_TIMEOUT,
+                   limit=1):
+    """
+    Fetches the top posts of each subreddit concurrently and yields the posts
+    as their listings arrive.
+    
+    Arguments:
+        subreddits -- the subreddits to fetch listings from
+        workers -- max number of listings fetched at once
+        timeout -- seconds after which a listing request is given up on
+        limit -- number of top posts to take from each subreddit
+    """
+    log = logs.get_logger()
+    started = {}
+    
+    def fetch(subreddit):
+        started[subreddit] = time.time()
+        with metrics.timer('listing_seconds', subreddit=subreddit):
+            return top_of_day(subreddit, limit)
+    
+    # hung requests keep their worker busy, so give up on the whole stage once
+    # even the slowest legitimate schedule would have finished
+    rounds = -(-len(subreddits) // workers)
+    deadline = time.time() + timeout * rounds
+    
+    pool = ThreadPoolExecutor(max_workers=workers)
+    jobs = {pool.submit(fetch, subreddit): subreddit for subreddit in subreddits}
+    pending = set(jobs)
+    try:
+        while pending:
+            done, pending = wait(pending, timeout=LISTING_POLL,
+                                 return_when=FIRST_COMPLETED)
+            for job in done:
+                try:
+                    for submission in job.result():
+                        yield submission
+                except Exception as e:
+                    metrics.count('listing_errors_total', subreddit=jobs[job])
+                    log.warning('could not fetch listing of %s: %r'
+                                % (jobs[job], e))
+            
+            # the consumer may have kept us waiting at yield for a while;
+            # listings that finished meanwhile are yielded on the next round
+            now = time.time()
+            for job in list(pending):
+                if job.done():
+                    continue
+                start = started.get(jobs[job])
+                if now > deadline or \
+                        (start is not None and now - start > timeout):
+                    log.warning('gave up on listing of %s after %d seconds'
+                                % (jobs[job], timeout))
+                    job.cancel()
+                    pending.discard(job)
+    finally:
+        # don't wait on requests that were given up on
+        pool.shutdown(wait=False)
+
+def topmost_post(subreddits, workers=LISTING_WORKERS, timeout=LISTING_TIMEOUT):
     """Returns the highest-upvoted post of all subreddits."""
-    tops = all_top_posts(subreddits)
-    top = tops[0]
-    for submission in tops:
-        if submission.score > top.score:
+    top = None
+    for submission in iter_top_posts(subreddits, workers, timeout):
+        if top is None or submission.score > top.score:
             top = submission
-    return [top]
+    return [top] if top is not None else []
 
-def all_top_posts(subreddits):
-    """Returns a list of top posts, one for each in subreddits."""
-    tops = []
-    for subreddit in subreddits:
-        # TODO : Maybe change this limit?
-        # WARN : If the subreddit has low activity, this function may fail
-        for submission in subreddit.top(time_filter='day', limit=1):
-            tops.append(submission)
-    return tops
+def all_top_posts(subreddits, workers=LISTING_WORKERS, timeout=LISTING_TIMEOUT,
+                  limit=1):
+    """Returns a list of top posts, limit for each in subreddits."""
+    return list(iter_top_posts(subreddits, workers, timeout, limit))
 
-def rand_top_post(subreddits):
-    """Chooses a random subreddit and grabs the top post from that."""
+def rand_top_post(subreddits, limit=1):
+    """Chooses a random subreddit and grabs the top posts from that."""
     tops = []
     subreddit = subreddits[random.randint(0, len(subreddits) - 1)]
-    for submission in subreddit.top(time_filter='day', limit=1):
+    for submission in subreddit.top(time_filter='day', limit=limit):
         tops.append(submission)
     
     if tops == []:
         # subreddit isn't active enough -- no 'top' post
         # try something else
-        for submission in subreddit.hot(limit=3):
+        for submission in subreddit.hot(limit=max(3, limit)):
             tops.append(submission)
     
     return tops
 
-def grab_images(dat):
+def candidate_message(candidate):
+    """Returns the log entry describing a finished candidate."""
+    source = candidate.post.permalink if candidate.post is not None \
+             else candidate.url
+    if candidate.result == ERR_SEEN_POST:
+        message = str(datetime.datetime.now()) + ': post skipped --' +      \
+                    '\n\tsource: \t' + str(source) + '\n\tresult: \t'
+    elif candidate.gallery:
+        message = str(datetime.datetime.now()) + ': gallery saved --' +     \
+                    '\n\tsource: \t' + str(source) + '\n\tresult: '
+    else:
+        message = str(datetime.datetime.now()) + ': image saved --' +       \
+                    '\n\tsource: \t' + str(source) +                     \
+                    '\n\tlocation: \t' + str(candidate.path) + '\n\tresult: \t'
+    
+    message += result_message(candidate.result)
+    if candidate.error is not None:
+        message += '\terror: \t' + repr(candidate.error) + '\n'
+    return message
+
+def finish_candidate(candidate, dat, log):
+    """
+    Last step of every candidate: releases its temp file and, unless an image
+    was stored there, its path, remembers that its post was processed, unless
+    it failed and should be tried again, and logs the outcome. Returns the
+    result code.
+    """
+    if candidate.lock is not None:
+        candidate.lock.release()
+    if candidate.error is not None:
+        candidate.result = ERR_DOWNLOAD_FAILED
+    if candidate.path is not None and candidate.result != NO_ERROR and \
+            not os.path.exists(candidate.path):
+        release_paths(dat, [candidate.path])
+    
+    if candidate.post is not None and \
+            candidate.result not in (ERR_SEEN_POST, ERR_DOWNLOAD_FAILED):
+        seen.mark_seen(candidate.post, store.get_store())
+    result = RESULT_NAMES.get(candidate.result, 'unknown')
+    metrics.count('posts_total', result=result)
+    
+    post = candidate.post
+    log.info(candidate_message(candidate), extra={
+        'post' : post.id if post is not None else None,
+        'subreddit' : getattr(post, 'subreddit', None),
+        'url' : candidate.url,
+        'path' : candidate.path,
+        'bytes' : candidate.bytes,
+        'duration' : round(time.time() - candidate.started, 3),
+        'result' : result,
+    })
+    return candidate.result
+
+def result_message(result):
+    """Returns the line describing a result code in the log."""
+    if result == NO_ERROR:
+        return 'SUCCESSFULLY SAVED\n'
+    elif result == ERR_NOT_IMAGE:
+        return 'UNSUCCESSFUL -- POST WAS NOT IMAGE\n'
+    elif result == ERR_DUPLICATE_IMAGE:
+        return 'UNSUCCESSFUL -- POST WAS DUPLICATE\n'
+    elif result == ERR_DUPLICATE_GALLERY:
+        return 'UNSUCCESSFUL -- ALREADY VISITED THIS GALLERY\n'
+    elif result == ERR_WRONG_SIZE:
+        return 'UNSUCCESSFUL -- IMAGE DID NOT MATCH SIZE FILTERS\n'
+    elif result == ERR_SEEN_POST:
+        return 'UNSUCCESSFUL -- ALREADY PROCESSED THIS POST\n'
+    elif result == ERR_DOWNLOAD_FAILED:
+        return 'UNSUCCESSFUL -- DOWNLOAD FAILED\n'
+    else:
+        return 'CRITICAL ERROR -- CONTACT DEVELOPER\n'
+
+def list_posts(subreddits, dat):
+    """
+    Returns the posts to save according to the user's post save method. The
+    posts may be yielded while the listings are still being fetched.
+    """
+    method = dat.configdata['postsave']
+    settings = dat.configdata['download']
+    workers = settings['listing_workers']
+    timeout = settings['listing_timeout']
+    limit = settings['posts_per_listing']
+    if method == 0:
+        return topmost_post(subreddits, workers, timeout)
+    elif method == 1:
+        return iter_top_posts(subreddits, workers, timeout, limit)
+    elif method == 2:
+        return rand_top_post(subreddits, limit)
+    else:
+        raise Exception('Bad config data (post save method): %s' % (str(method)))
+
+def grab_images(dat, reddit=None):
     """
     Retrieves a set of images to save.
 
     Reaches out to Reddit and retrieves a set of top images to store in the
     user-specified location.
+    
+    The posts stream through a pipeline whose steps each run on their own
+    threads: listing fetch -> filter_candidate -> fetch_candidate ->
+    validate_candidate -> dedupe_candidate -> store_candidate ->
+    finish_candidate. The steps are connected by bounded queues, so the number
+    of posts in flight stays bounded however many posts the listings hold, and
+    a slow step holds back the ones before it. The number of threads of each
+    step is set in the [download] section of the config. Images are decoded
+    and hashed in worker processes, one per core by default, so decoding a
+    large batch doesn't stall the downloads.
 
     Arguments:
         dat -- save data
+        reddit -- client to fetch the listings with; the shared praw client
+                  by default
+    Returns:
+        the result code of each post, in the order they finished
     """
-    # TODO : Grab images by resolution / resolution minimum
     # TODO : Validate that the image isn't empty
 
-    reddit = Reddit().reddit
+    settings = dat.configdata['download']
+    endpoints = dat.configdata['endpoints']
+    # every download worker may be saving an album with album_workers threads,
+    # all from i.imgur.com; a smaller pool would drop connections it can't keep
+    pool_maxsize = max(settings['pool_maxsize'],
+                       settings['workers'] * settings['album_workers'])
+    httpclient.configure(settings['pool_connections'], pool_maxsize,
+                         endpoints['media'])
+    if reddit is None:
+        from reddit import get_reddit
+        reddit = get_reddit(endpoints['reddit'])
     subreddit_names = dat.configdata['subreddits']
     subreddits = [reddit.subreddit(name) for name in subreddit_names]
-    log = get_logger() # TODO : make accessible to other functions?
-
-    # use different method to save image depending on user's stated preferencedata['subreddits']
-    method = dat.configdata['postsave']
-    if method == 0:
-        top_posts = topmost_post(subreddits)
-    elif method == 1:
-        top_posts = all_top_posts(subreddits)
-    elif method == 2:
-        top_posts = rand_top_post(subreddits)
-    else:
-        raise Exception('Bad config data (post save method): %s' % (str(method)))
+    log = logs.get_logger()
 
-    increment = 0
-    for post in top_posts: # TODO : assumes that each post has a media element
-        permalink = post.permalink
-        url = post.url
-        
-        combined_path = combine_paths(dat, increment)
-        increment += 1
-        
-        # determine if url is direct image link or link to imgur gallery
-        if 'imgur' in url:
-            result = download_imgur(url, dat)
-            message = str(datetime.datetime.now()) + ': gallery saved --' +   \
-                        '\n\tsource: \t' + str(permalink) + '\n\tresult: '
-                              
-        else:
-            result = download_image(combined_path, url, dat)
-            message = str(datetime.datetime.now()) + ': image saved --' +     \
-                        '\n\tsource: \t' + str(permalink) +                   \
-                        '\n\tlocation: \t' + combined_path + '\n\tresult: \t'
-                    
-        # TODO if download is unsuccessful, try something else
-        if result == NO_ERROR:
-            message += 'SUCCESSFULLY SAVED\n'
-        elif result == ERR_NOT_IMAGE:
-            message += 'UNSUCCESSFUL -- POST WAS NOT IMAGE\n'
-        elif result == ERR_DUPLICATE_IMAGE:
-            message += 'UNSUCCESSFUL -- POST WAS DUPLICATE\n'
-        elif result == ERR_DUPLICATE_GALLERY:
-            message += 'UNSUCCESSFUL -- ALREADY VISITED THIS GALLERY\n'
-        else:
-            message += 'CRITICAL ERROR -- CONTACT DEVELOPER\n'
-
-        log.info(message)
\ No newline at end of file
+    # the filter keeps track of the batch, so it runs on a single thread
+    batch = set()
+    stages = [
+        pipeline.Stage('filter', lambda c: filter_candidate(c, dat, batch)),
+        pipeline.Stage('download', lambda c: fetch_candidate(c, dat),
+                       settings['workers']),
+        # these threads only wait for the worker processes
+        pipeline.Stage('validate', lambda c: validate_candidate(c, dat),
+                       imagecheck.worker_count(settings['check_workers'])),
+        pipeline.Stage('dedupe', lambda c: dedupe_candidate(c, dat),
+                       settings['dedupe_workers']),
+        pipeline.Stage('store', lambda c: store_candidate(c, dat),
+                       settings['store_workers']),
+    ]
+    
+    results = []
+    sink = lambda candidate: results.append(
+        finish_candidate(candidate, dat, log))
+    source = (Candidate(post.url, post) for post in list_posts(subreddits, dat))
+    pipeline.Pipeline(stages, sink, settings['queue_size']).run(source)
+    
+    with metrics.timer('state_write_seconds', data='hashindex'):
+        hashindex.save_all()
+    
+    return results
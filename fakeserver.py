@@ -0,0 +1,263 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# local stand-in for reddit and the image hosts that records and replays
+# their responses
+#
+#   python fakeserver.py record DIR   forward requests to the real hosts and
+#                                     save every response in DIR
+#   python fakeserver.py replay DIR   answer requests with the saved responses
+#
+# Point the program at it in backgrounder.ini:
+#
+#   [endpoints]
+#   reddit = http://127.0.0.1:8080
+#   media = http://127.0.0.1:8080
+#
+# Replayed responses can be slowed down and broken on purpose with --latency,
+# --bandwidth, --error-rate and --truncate-rate.
+#
+
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import http.server
+from urllib.parse import urlsplit
+
+PORT = 8080
+CHUNK_SIZE = 16384
+
+API_HOST = 'oauth.reddit.com'
+TOKEN_HOST = 'www.reddit.com'
+TOKEN_PATH = '/api/v1/access_token'
+# response headers that are recorded and replayed
+KEPT_HEADERS = ('Content-Type', 'ETag', 'Last-Modified', 'Location')
+# request headers that are passed on to the real hosts while recording
+FORWARDED_HEADERS = ('Authorization', 'User-Agent', 'Accept', 'Content-Type')
+
+def route(path):
+    """
+    Returns the (host, path) that a request for path stands in for.
+
+    Requests for images and albums carry the real host as the first part of
+    the path; see httpclient.EndpointAdapter. Everything else is a request to
+    the Reddit API, which praw sends to the server's root.
+    """
+    parts = path.lstrip('/').split('/', 1)
+    if '.' in parts[0]:
+        return parts[0], '/' + (parts[1] if len(parts) > 1 else '')
+    if urlsplit(path).path == TOKEN_PATH:
+        return TOKEN_HOST, path
+    return API_HOST, path
+
+def fake_token():
+    """Returns the body of a token response that any client accepts."""
+    return json.dumps({
+        'access_token' : 'replayed',
+        'token_type' : 'bearer',
+        'expires_in' : 3600,
+        'scope' : '*',
+    }).encode('utf-8')
+
+class Recording():
+    """Responses kept in a directory, one body and one header file each."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _base(self, method, host, path):
+        key = method + ' ' + host + path
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, host, name)
+
+    def load(self, method, host, path):
+        """Returns (status, headers, body) of a saved response, or None."""
+        base = self._base(method, host, path)
+        try:
+            with open(base + '.json', 'r') as input:
+                meta = json.load(input)
+            with open(base + '.body', 'rb') as input:
+                body = input.read()
+        except (OSError, ValueError):
+            return None
+        return meta['status'], meta['headers'], body
+
+    def save(self, method, host, path, status, headers, body):
+        base = self._base(method, host, path)
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        meta = {
+            'url' : 'https://' + host + path,
+            'status' : status,
+            'headers' : headers,
+        }
+        # the body goes first, so a response with headers is always complete
+        for suffix, mode, content in (('.body', 'wb', body),
+                                      ('.json', 'w', json.dumps(meta, indent=4))):
+            with open(base + suffix + '.tmp', mode) as out:
+                out.write(content)
+            os.replace(base + suffix + '.tmp', base + suffix)
+
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive like the real hosts
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else b''
+        host, path = route(self.path)
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and random.random() < server.error_rate:
+            self.respond(server.error_status, {}, b'injected error')
+            return
+
+        if server.mode == 'record':
+            response = server.forward(method, host, path, self.headers, body)
+        elif (host, urlsplit(path).path) == (TOKEN_HOST, TOKEN_PATH):
+            response = (200, {'Content-Type' : 'application/json'}, fake_token())
+        else:
+            response = server.recording.load(method, host, path)
+        if response is None:
+            self.respond(404, {}, b'not recorded')
+            return
+
+        status, headers, content = response
+        if method == 'GET' and status == 200 and self.is_unchanged(headers):
+            self.respond(304, headers, b'')
+            return
+        truncate = server.truncate_rate and random.random() < server.truncate_rate
+        self.respond(status, headers, content, truncate)
+
+    def is_unchanged(self, headers):
+        """Answers conditional requests the way the real hosts would."""
+        etag = headers.get('ETag')
+        if etag and self.headers.get('If-None-Match') == etag:
+            return True
+        modified = headers.get('Last-Modified')
+        return bool(modified) and self.headers.get('If-Modified-Since') == modified
+
+    def respond(self, status, headers, body, truncate=False):
+        """
+        Sends a response at the server's bandwidth. A truncated response
+        announces its full length but breaks off halfway.
+        """
+        self.send_response(status)
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if truncate:
+            body = body[:len(body) // 2]
+            self.close_connection = True
+
+        for start in range(0, len(body), CHUNK_SIZE):
+            chunk = body[start:start + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            if self.server.bandwidth:
+                time.sleep(len(chunk) / float(self.server.bandwidth))
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+class FakeServer(http.server.ThreadingHTTPServer):
+    """
+    Serves the responses in a Recording, or records them from the real hosts.
+
+    Arguments:
+        directory -- where the responses are kept
+        mode -- 'replay' or 'record'
+        port -- port to listen on; 0 picks a free one
+        latency -- seconds to wait before answering a request
+        bandwidth -- bytes per second each response is sent at; 0 for no limit
+        error_rate -- share of requests answered with error_status instead
+        truncate_rate -- share of responses that break off halfway
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, mode='replay', port=PORT, latency=0,
+                 bandwidth=0, error_rate=0, error_status=503, truncate_rate=0,
+                 verbose=False):
+        super().__init__(('127.0.0.1', port), FakeHandler)
+        self.recording = Recording(directory)
+        self.mode = mode
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.truncate_rate = truncate_rate
+        self.verbose = verbose
+        self.session = None
+
+    @property
+    def base(self):
+        """Base url to put into the [endpoints] section of the config."""
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        """Serves requests on a background thread and returns self."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def forward(self, method, host, path, headers, body):
+        """
+        Sends a request on to the real host and records the response. Access
+        tokens are passed on but never recorded; replays hand out a fake one.
+        """
+        import requests
+        if self.session is None:
+            self.session = requests.Session()
+        forwarded = {key : headers[key] for key in FORWARDED_HEADERS
+                     if key in headers}
+        response = self.session.request(method, 'https://' + host + path,
+                                        headers=forwarded, data=body,
+                                        allow_redirects=False, timeout=60)
+        kept = {key : response.headers[key] for key in KEPT_HEADERS
+                if key in response.headers}
+        if urlsplit(path).path != TOKEN_PATH:
+            self.recording.save(method, host, path, response.status_code, kept,
+                                response.content)
+        return response.status_code, kept, response.content
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for reddit and the image hosts.')
+    parser.add_argument('mode', choices=('record', 'replay'))
+    parser.add_argument('directory', help='where the responses are kept')
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds before each response')
+    parser.add_argument('--bandwidth', type=float, default=0,
+                        help='KB/s per response, 0 for no limit')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='share of requests that fail, 0 to 1')
+    parser.add_argument('--error-status', type=int, default=503)
+    parser.add_argument('--truncate-rate', type=float, default=0,
+                        help='share of responses that break off halfway, 0 to 1')
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    server = FakeServer(args.directory, args.mode, args.port,
+                        args.latency / 1000.0, args.bandwidth * 1000,
+                        args.error_rate, args.error_status, args.truncate_rate,
+                        args.verbose)
+    print('%s %s on %s' % (args.mode, args.directory, server.base))
+    print('set reddit and media in the [endpoints] section of backgrounder.ini to it')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,7 +6,7 @@
 # extra junk to make sure we can import from a parent directory
 from os import sys, path
 sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
-from reddit import Reddit
+from reddit import get_reddit
 from gui.tooltip import Tooltip
 
 import tkinter as tk
@@ -87,7 +87,7 @@ class Config_Subs():
         self.customsub_frame = customsub_frame
         self.customsub_input = customsub_input
 
-        self.reddit = Reddit().reddit
+        self.reddit = get_reddit()
         self.customsub_num = 0
         self.customsubs = {}
 
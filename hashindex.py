@@ -0,0 +1,292 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# persistent perceptual-hash index used to detect duplicate images
+#
+
+import os
+import pickle
+import store
+import threading
+import imagecheck
+from contextlib import nullcontext
+
+LEGACY_FILE = 'hashindex.pkl' # where the index was kept before the store
+EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+HASH_SIZE = 8 # difference hash over an 8x8 grid -> 64 bit hash
+HASH_BITS = HASH_SIZE * HASH_SIZE
+BANDS = 5 # hash is split into this many bands; see the store's schema
+MAX_DISTANCE = BANDS - 1 # any two hashes this close share at least one band
+MAX_ASPECT_DELTA = 0.01 # resized copies keep their aspect ratio
+# Flat or nearly flat images, such as a plain color with a little text, hash
+# to (almost) all zeros or all ones whatever they show, so such hashes don't
+# tell images apart; those images are only matched by their exact digest.
+MIN_HASH_BITS = 8
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def dhash(image):
+    """
+    Computes the 64-bit difference hash of a PIL image.
+
+    The image is shrunk to a (HASH_SIZE + 1) x HASH_SIZE grayscale thumbnail
+    and each bit records whether a pixel is brighter than its right neighbor.
+    Re-encoding or resizing an image barely changes the result, so copies end
+    up within a small Hamming distance of each other.
+    """
+    from PIL import Image
+    # let the JPEG decoder downscale while decoding, which is much cheaper
+    # than decoding the full image and resizing it afterwards
+    image.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))
+    small = image.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(small.getdata())
+
+    value = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + col]
+            right = pixels[row * (HASH_SIZE + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+def describe(image_path):
+    """
+    Returns a (hash, width, height) tuple for an image. image_path may also be
+    a file object, such as a buffer holding a download.
+    """
+    from PIL import Image
+    with Image.open(image_path) as image:
+        width, height = image.size
+        return dhash(image), width, height
+
+def bands(value):
+    """Splits a hash into BANDS keys, one per contiguous range of bits."""
+    keys = []
+    for band in range(BANDS):
+        start = band * HASH_BITS // BANDS
+        stop = (band + 1) * HASH_BITS // BANDS
+        keys.append((value >> start) & ((1 << (stop - start)) - 1))
+    return keys
+
+def to_signed(value):
+    """SQLite stores signed 64 bit integers; maps a hash into that range."""
+    return value - (1 << HASH_BITS) if value >= 1 << (HASH_BITS - 1) else value
+
+def to_unsigned(value):
+    return value + (1 << HASH_BITS) if value < 0 else value
+
+def distance(a, b):
+    """Returns the Hamming distance between two hashes."""
+    return bin(a ^ b).count('1')
+
+def is_conclusive(value):
+    """
+    Returns False for hashes with too few or too many bits set to say
+    whether two images look the same.
+    """
+    return MIN_HASH_BITS <= bin(value).count('1') <= HASH_BITS - MIN_HASH_BITS
+
+class HashIndex():
+    """
+    Maps every image in a directory to its perceptual hash, dimensions and
+    content digest.
+
+    The index lives in the store and is only updated for files that were
+    added, changed or removed since it was last synchronized, so a lookup
+    never has to decode the rest of the library. Hashes are bucketed by band;
+    by the pigeonhole principle two hashes within MAX_DISTANCE of each other
+    agree on at least one band, so only the images sharing an indexed band
+    with the query need to be compared.
+    """
+    def __init__(self, directory, db):
+        self.directory = directory
+        self.db = db
+        self.unreadable = set() # files that couldn't be indexed, not tried again
+        self.sync_lock = threading.Lock() # one sync at a time
+
+    def _insert(self, filename, mtime, value, width, height, digest):
+        self.db.execute(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            [filename, mtime, to_signed(value), width, height, digest] + bands(value))
+
+    def _remove(self, filename):
+        self.db.execute('DELETE FROM hashes WHERE filename = ?', (filename,))
+
+    def _remember_directory(self):
+        try:
+            self.db.set_meta('hash_dir_mtime', os.stat(self.directory).st_mtime)
+        except OSError:
+            pass
+
+    def sync(self, guard=None, workers=0):
+        """
+        Brings the index up to date with the directory. The directory is only
+        listed if its modification time changed since the last sync, and only
+        the files whose names aren't indexed yet are read and decoded; the
+        rest of the library isn't even stat'ed. Images written through add()
+        don't make the directory be listed again.
+
+        New images are decoded and hashed in imagecheck's worker processes.
+        guard, a lock shared with whoever else uses the store, is only held
+        while the index is read and updated, not while the images are hashed.
+
+        Arguments:
+            guard -- lock to hold while using the store, if any
+            workers -- number of worker processes, see imagecheck.get_pool
+        """
+        guard = guard if guard is not None else nullcontext()
+        with self.sync_lock:
+            with guard:
+                changes = self._changes()
+            if changes is None:
+                return
+            dir_mtime, added, removed = changes
+
+            paths = [os.path.join(self.directory, filename) for filename in added]
+            described = imagecheck.run_all(imagecheck.describe_file, paths, workers)
+
+            with guard:
+                for filename, entry in zip(added, described):
+                    if entry is None:
+                        # unreadable or not actually an image
+                        self.unreadable.add(filename)
+                        continue
+                    mtime, digest, value, width, height = entry
+                    self._insert(filename, mtime, value, width, height, digest)
+                for filename in removed:
+                    self._remove(filename)
+                self.db.set_meta('hash_dir_mtime', dir_mtime)
+
+    def _changes(self):
+        """
+        Returns (dir_mtime, added, removed) -- the names of the images that
+        aren't indexed yet and of those that are gone -- or None if the
+        directory didn't change since the last sync.
+        """
+        if self.db.get_meta('hash_directory') != self.directory:
+            # a different directory was chosen; its index starts from scratch
+            self.db.execute('DELETE FROM hashes')
+            self.db.set_meta('hash_directory', self.directory)
+            self.db.set_meta('hash_dir_mtime', None)
+
+        try:
+            dir_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            return None
+        if str(dir_mtime) == self.db.get_meta('hash_dir_mtime'):
+            return None
+
+        known = set(row[0] for row in self.db.query('SELECT filename FROM hashes'))
+        present = set(filename for filename in os.listdir(self.directory)
+                      if filename.lower().endswith(EXTENSIONS))
+        return (dir_mtime, sorted(present - known - self.unreadable),
+                known - present)
+
+    def find(self, value, width, height, exclude=None):
+        """
+        Returns the filename of an indexed image that looks the same as an
+        image with the given hash and dimensions, or None if there is none.
+        Images whose hash isn't conclusive never look the same as another;
+        compare their digests with has_digest instead.
+
+        Arguments:
+            value -- perceptual hash of the image in question
+            width, height -- dimensions of the image in question
+            exclude -- filename to ignore, so an image doesn't match itself
+        """
+        if not is_conclusive(value):
+            return None
+        aspect = width / float(height)
+        where = ' OR '.join('band%d = ?' % band for band in range(BANDS))
+        candidates = self.db.query(
+            'SELECT filename, hash, width, height FROM hashes WHERE ' + where,
+            bands(value))
+
+        for filename, other, other_width, other_height in candidates:
+            if filename == exclude:
+                continue
+            if distance(value, to_unsigned(other)) > MAX_DISTANCE:
+                continue
+            other_aspect = other_width / float(other_height)
+            if abs(aspect - other_aspect) > MAX_ASPECT_DELTA * aspect:
+                continue
+            return filename
+        return None
+
+    def has_digest(self, digest, exclude=None):
+        """
+        Returns True if an indexed image other than exclude has exactly the
+        given content digest.
+        """
+        return bool(self.db.query(
+            'SELECT 1 FROM hashes WHERE digest = ? AND filename IS NOT ? LIMIT 1',
+            (digest, exclude)))
+
+    def add(self, image_path, digest, value, width, height):
+        """
+        Adds an image stored in the indexed directory to the index.
+
+        Arguments:
+            image_path -- path to the stored image
+            digest -- hex content digest of the image, see httpclient.new_digest()
+            value, width, height -- the image's description, see describe()
+        """
+        filename = os.path.basename(image_path)
+        self._insert(filename, os.stat(image_path).st_mtime, value, width,
+                     height, digest)
+        # our own write changed the directory; no need to list it again
+        self._remember_directory()
+
+    def discard(self, image_path):
+        """Removes an image from the index, e.g. after it was deleted."""
+        self._remove(os.path.basename(image_path))
+
+    def save(self):
+        """Commits the changes made to the index."""
+        self.db.commit()
+
+    def migrate(self):
+        """
+        Imports the index pickled by earlier versions, if there is one, so the
+        library doesn't have to be hashed again.
+        """
+        if not os.path.isfile(LEGACY_FILE):
+            return
+        try:
+            with open(LEGACY_FILE, 'rb') as input:
+                legacy = pickle.load(input)
+            if legacy.directory == self.directory:
+                for filename, entry in legacy.entries.items():
+                    mtime, value, width, height, digest = entry
+                    self._insert(filename, mtime, value, width, height, digest)
+                self.db.set_meta('hash_directory', self.directory)
+                self.db.set_meta('hash_dir_mtime', legacy.dir_mtime)
+                self.db.commit()
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError,
+                ValueError):
+            pass # the index will be rebuilt from the directory instead
+        os.replace(LEGACY_FILE, LEGACY_FILE + '.migrated')
+
+def get_index(directory, sync=True, guard=None, workers=0):
+    """
+    Returns the hash index for directory, synchronizing it with the
+    directory's contents. Later requests only synchronize it again if sync
+    is set; it needn't be when an image is about to be added. See
+    HashIndex.sync for guard and workers.
+    """
+    with _indexes_lock:
+        index = _indexes.get(directory)
+        created = index is None
+        if created:
+            index = _indexes[directory] = HashIndex(directory, store.get_store())
+            with guard if guard is not None else nullcontext():
+                index.migrate()
+    if created or sync:
+        index.sync(guard, workers)
+    return index
+
+def save_all():
+    """Commits the changes made to every index used during this run."""
+    for index in _indexes.values():
+        index.save()
@@ -0,0 +1,293 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# shared HTTP session used for every request to image hosts
+#
+
+import os
+import errno
+import hashlib
+import requests
+import threading
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+
+POOL_CONNECTIONS = 10 # number of hosts to keep connection pools for
+POOL_MAXSIZE = 10 # number of connections kept alive per host
+
+CHUNK_SIZE = 65536
+HEAD_LIMIT = 262144 # max number of leading bytes shown to an inspect callback
+PART_DIR = '.partial' # subdirectory of the image directory holding temp files
+PART_SUFFIX = '.part'
+VALIDATOR_SUFFIX = '.validator'
+
+_session = None
+_pool_sizes = None
+_media_url = ''
+_part_locks = {}
+_lock = threading.Lock()
+
+class EndpointAdapter(HTTPAdapter):
+    """
+    Sends every request to a stand-in for the real hosts, such as
+    fakeserver.py. The host of the original url becomes the first part of the
+    path, e.g. https://i.redd.it/abc.jpg turns into <endpoint>/i.redd.it/abc.jpg.
+    """
+    def __init__(self, endpoint, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint.rstrip('/') + '/'
+
+    def send(self, request, **kwargs):
+        request.url = endpoint_url(self.endpoint, request.url)
+        return super().send(request, **kwargs)
+
+def endpoint_url(endpoint, url):
+    """Returns the url on endpoint that stands in for url."""
+    parts = urlsplit(url)
+    return endpoint.rstrip('/') + '/' + parts.netloc + parts.path + \
+           ('?' + parts.query if parts.query else '')
+
+class Rejected(Exception):
+    """
+    Raised by an inspect callback to abort a download. Its argument tells the
+    caller why the download was rejected.
+    """
+    pass
+
+def configure(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE,
+              media_url=''):
+    """
+    Sets the connection pool sizes of the shared session, creating the session
+    if needed. pool_maxsize should be at least the number of concurrent
+    downloads, otherwise connections are dropped instead of kept alive.
+
+    If media_url is set, every request made with the session is sent there
+    instead of to the real host; see EndpointAdapter.
+    """
+    global _session, _pool_sizes, _media_url
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.headers['Accept-Encoding'] = 'gzip, deflate'
+        if _pool_sizes == (pool_connections, pool_maxsize) and \
+                _media_url == media_url:
+            return
+        if media_url:
+            adapter = EndpointAdapter(media_url, pool_connections=pool_connections,
+                                      pool_maxsize=pool_maxsize)
+        else:
+            adapter = HTTPAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+        _pool_sizes = (pool_connections, pool_maxsize)
+        _media_url = media_url
+
+def get_session():
+    """
+    Returns the process-wide requests session.
+
+    Sharing one session keeps connections (and their TLS sessions) alive
+    between requests to the same host, such as i.redd.it or i.imgur.com, and
+    asks for compressed transfer on every response.
+    """
+    if _session is None:
+        configure()
+    return _session
+
+def new_digest():
+    """Returns the hashlib object used for exact content digests."""
+    return hashlib.sha256()
+
+def part_path(url, directory):
+    """
+    Returns the temp file a download of url is written to until it is
+    complete. The name only depends on the url, so an interrupted download is
+    picked up again the next time the same url is requested.
+
+    Temp files are kept in a subdirectory of directory: it's on the same file
+    system, so they can still be moved into place atomically, but creating
+    and deleting them doesn't change the modification time of directory,
+    which would make the hash index and the id allocator list it again.
+    """
+    name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    parts = os.path.join(directory, PART_DIR)
+    os.makedirs(parts, exist_ok=True)
+    return os.path.join(parts, name + PART_SUFFIX)
+
+class PartLock():
+    """
+    Lock on a single temp file. It's forgotten as soon as no thread holds it
+    or waits for it, so the locks don't pile up in a long-running process.
+    """
+    def __init__(self, part):
+        self.part = part
+        self.users = 0 # threads that asked for the lock and haven't released it
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.lock.acquire()
+
+    def release(self):
+        self.lock.release()
+        with _lock:
+            self.users -= 1
+            if self.users == 0 and _part_locks.get(self.part) is self:
+                del _part_locks[self.part]
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+def part_lock(part):
+    """
+    Returns the lock that must be held while working on a temp file. Every
+    call must be followed by acquiring the lock and releasing it again.
+    """
+    with _lock:
+        lock = _part_locks.get(part)
+        if lock is None:
+            lock = _part_locks[part] = PartLock(part)
+        lock.users += 1
+        return lock
+
+def _read_validator(part):
+    try:
+        with open(part + VALIDATOR_SUFFIX, 'r') as input:
+            return input.read().strip() or None
+    except OSError:
+        return None
+
+def _write_validator(part, response):
+    validator = response.headers.get('ETag') or \
+                response.headers.get('Last-Modified')
+    if validator:
+        with open(part + VALIDATOR_SUFFIX, 'w') as out:
+            out.write(validator)
+    elif os.path.isfile(part + VALIDATOR_SUFFIX):
+        os.remove(part + VALIDATOR_SUFFIX)
+
+def download_part(url, part, inspect=None):
+    """
+    Downloads url into the temp file part and returns the hex digest of the
+    complete content.
+
+    If part already holds the beginning of the content from an interrupted
+    download, only the rest is requested with an HTTP Range request. The
+    If-Range header makes the server send the whole content instead if it
+    changed in the meantime. If the transfer breaks off again, part is kept
+    so that the next attempt can resume it.
+
+    inspect(headers, head) lets the caller abort a transfer early. It is
+    called with the response headers and an empty head before any of the body
+    is read, then again with the first bytes of the content every time more
+    of them arrive, until it returns True or HEAD_LIMIT bytes were seen. It
+    raises Rejected to stop the download; part is deleted in that case.
+
+    Raises:
+        requests.HTTPError -- the server answered with an error
+        IOError -- the transfer ended before all of the content arrived
+        Rejected -- inspect rejected the download
+    """
+    digest = new_digest()
+    offset = 0
+    head = bytearray()
+    headers = {
+        # byte ranges refer to the encoded content, so don't let it be encoded
+        'Accept-Encoding' : 'identity',
+    }
+
+    validator = _read_validator(part)
+    if validator and os.path.isfile(part):
+        with open(part, 'rb') as input:
+            for block in iter(lambda: input.read(CHUNK_SIZE), b''):
+                digest.update(block)
+                offset += len(block)
+                if len(head) < HEAD_LIMIT:
+                    head += block[:HEAD_LIMIT - len(head)]
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+
+    with get_session().get(url, headers=headers, stream=True) as response:
+        if response.status_code == 206 and \
+                response.headers.get('Content-Range', '').startswith(
+                    'bytes %d-' % offset):
+            mode = 'ab'
+        elif response.status_code == 416:
+            if offset and response.headers.get('Content-Range') == \
+                    'bytes */%d' % offset:
+                # the temp file was complete, it just wasn't moved into place
+                return digest.hexdigest()
+            # the content shrank, or changed; start over
+            return _restart(url, part, inspect)
+        else:
+            response.raise_for_status()
+            mode = 'wb'
+            offset = 0
+            head = bytearray()
+            digest = new_digest()
+
+        length = response.headers.get('Content-Length')
+        expected = offset + int(length) if length is not None else None
+
+        try:
+            done = inspect is None or \
+                   inspect(response.headers, bytes(head)) is True
+            if mode == 'wb':
+                _write_validator(part, response)
+
+            with open(part, mode) as out:
+                for block in response.iter_content(CHUNK_SIZE):
+                    if not block:
+                        break
+                    if not done and len(head) < HEAD_LIMIT:
+                        # check the new bytes before they hit the disk
+                        head += block[:HEAD_LIMIT - len(head)]
+                        done = inspect(response.headers, bytes(head)) is True
+                    digest.update(block)
+                    out.write(block)
+                    offset += len(block)
+        except Rejected:
+            discard_part(part)
+            raise
+
+    if expected is not None and offset < expected:
+        raise IOError('download of %s ended after %d of %d bytes'
+                      % (url, offset, expected))
+
+    return digest.hexdigest()
+
+def _restart(url, part, inspect):
+    discard_part(part)
+    return download_part(url, part, inspect)
+
+def commit_part(part, path):
+    """
+    Moves a completed temp file into place in one atomic step. Raises
+    FileExistsError instead of replacing a file that is already at path.
+    """
+    if os.path.exists(path):
+        raise FileExistsError(errno.EEXIST, 'not replacing existing file', path)
+    os.replace(part, path)
+    if os.path.isfile(part + VALIDATOR_SUFFIX):
+        os.remove(part + VALIDATOR_SUFFIX)
+
+def discard_part(part):
+    """Deletes a temp file that is no longer needed."""
+    for name in (part, part + VALIDATOR_SUFFIX):
+        if os.path.isfile(name):
+            os.remove(name)
+
+def retrieve(url, path, inspect=None):
+    """
+    Downloads url to path and returns the hex digest of its content. The
+    content only appears at path once it is complete, and an interrupted
+    download is resumed the next time. See download_part for inspect.
+    """
+    part = part_path(url, os.path.dirname(path))
+    with part_lock(part):
+        digest = download_part(url, part, inspect)
+        commit_part(part, path)
+    return digest
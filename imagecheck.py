@@ -0,0 +1,123 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# CPU-bound checks of downloaded images, run in worker processes
+#
+
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+_pool = None
+_pool_workers = None
+_lock = threading.Lock()
+
+def check(path, describe=False):
+    """
+    Decodes the whole image stored at path.
+
+    Arguments:
+        path -- the image file to check, or a file object holding it
+        describe -- whether to compute the image's perceptual hash as well
+    Returns:
+        (width, height, hash) -- hash is None unless describe is set
+        None -- the file isn't an image, or is truncated or corrupt
+    """
+    from PIL import Image
+    import hashindex
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+            # only decoding every pixel notices a truncated or corrupt file
+            image.load()
+            # hash the pixels that were just decoded instead of decoding again
+            value = hashindex.dhash(image) if describe else None
+    except (OSError, SyntaxError, ValueError):
+        return None
+    return width, height, value
+
+def describe_file(path):
+    """
+    Reads an image stored in the image directory once, for both its content
+    digest and its description, as needed by the hash index.
+
+    Returns:
+        (mtime, digest, hash, width, height) -- digest is the hex content digest
+        None -- the file can't be read, or isn't an intact image
+    """
+    import httpclient
+    try:
+        mtime = os.stat(path).st_mtime
+        with open(path, 'rb') as input:
+            content = input.read()
+    except OSError:
+        return None
+    checked = check(io.BytesIO(content), describe=True)
+    if checked is None:
+        return None
+    digest = httpclient.new_digest()
+    digest.update(content)
+    width, height, value = checked
+    return mtime, digest.hexdigest(), value, width, height
+
+def worker_count(workers=0):
+    """Returns the number of worker processes to use; 0 means one per core."""
+    return workers or os.cpu_count() or 1
+
+def get_pool(workers=0):
+    """
+    Returns the process pool that runs the checks, starting it on first use.
+    The pool is kept for the life of the process, so the workers only start
+    up once.
+    """
+    global _pool, _pool_workers
+    workers = worker_count(workers)
+    with _lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            # forking a process that runs threads can copy held locks, so the
+            # workers are started fresh on every platform
+            context = multiprocessing.get_context('spawn')
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+            _pool_workers = workers
+        return _pool
+
+def run_check(path, describe=False, workers=0):
+    """
+    Runs check(path, describe) in a worker process and waits for the result,
+    so decoding never holds up the threads that download. If the pool broke,
+    e.g. because a worker was killed, the check runs here instead and a new
+    pool is started next time.
+    """
+    global _pool
+    pool = get_pool(workers)
+    try:
+        return pool.submit(check, path, describe).result()
+    except BrokenProcessPool:
+        with _lock:
+            if _pool is pool:
+                _pool = None
+        return check(path, describe)
+
+def run_all(function, args, workers=0):
+    """
+    Runs function(arg) for every arg in the worker processes and returns the
+    results in order. function must be defined at the top level of a module,
+    so the workers can import it. Falls back to running here like run_check.
+    """
+    global _pool
+    args = list(args)
+    if not args:
+        return []
+    pool = get_pool(workers)
+    chunksize = max(1, len(args) // (worker_count(workers) * 4))
+    try:
+        return list(pool.map(function, args, chunksize=chunksize))
+    except BrokenProcessPool:
+        with _lock:
+            if _pool is pool:
+                _pool = None
+        return [function(arg) for arg in args]
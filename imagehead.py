@@ -0,0 +1,103 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# recognizes images from the first bytes of a download
+#
+
+SNIFF_SIZE = 12 # enough bytes to tell every supported format apart
+
+# leading bytes of every supported format
+SIGNATURES = [
+    (b'\x89PNG\r\n\x1a\n', 'png'),
+    (b'\xff\xd8\xff', 'jpeg'),
+    (b'GIF87a', 'gif'),
+    (b'GIF89a', 'gif'),
+    (b'BM', 'bmp'),
+    (b'II*\x00', 'tiff'),
+    (b'MM\x00*', 'tiff'),
+]
+
+# content types that may hold an image without saying which kind
+GENERIC_TYPES = ('application/octet-stream', 'binary/octet-stream')
+
+def sniff(head):
+    """
+    Returns the format of the image starting with the bytes in head, or None
+    if head doesn't start like any supported image. head should hold at least
+    SNIFF_SIZE bytes.
+    """
+    for signature, format in SIGNATURES:
+        if head.startswith(signature):
+            return format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def is_image_type(content_type):
+    """
+    Returns False if a Content-Type header says the content is definitely not
+    an image. A missing header is given the benefit of the doubt.
+    """
+    content_type = content_type.split(';')[0].strip().lower()
+    if not content_type:
+        return True
+    return content_type.startswith('image/') or content_type in GENERIC_TYPES
+
+def _big_endian(data):
+    return int.from_bytes(data, 'big')
+
+def _little_endian(data):
+    return int.from_bytes(data, 'little')
+
+# JPEG start-of-frame markers, which carry the image dimensions
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7,
+            0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+def _jpeg_dimensions(head):
+    pos = 2
+    while pos + 4 <= len(head):
+        if head[pos] != 0xFF:
+            return None # not a marker; the stream is corrupt
+        marker = head[pos + 1]
+        if marker == 0xFF:
+            pos += 1 # fill byte
+            continue
+        if marker in JPEG_SOF:
+            if pos + 9 > len(head):
+                return None
+            return _big_endian(head[pos + 7:pos + 9]), \
+                   _big_endian(head[pos + 5:pos + 7])
+        # skip over the segment to the next marker
+        pos += 2 + _big_endian(head[pos + 2:pos + 4])
+    return None
+
+def _webp_dimensions(head):
+    chunk = head[12:16]
+    if chunk == b'VP8 ' and len(head) >= 30:
+        return _little_endian(head[26:28]) & 0x3FFF, \
+               _little_endian(head[28:30]) & 0x3FFF
+    if chunk == b'VP8L' and len(head) >= 25:
+        bits = _little_endian(head[21:25])
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8X' and len(head) >= 30:
+        return _little_endian(head[24:27]) + 1, _little_endian(head[27:30]) + 1
+    return None
+
+def dimensions(head):
+    """
+    Returns the (width, height) of the image starting with the bytes in head,
+    read from its header without decoding anything. Returns None if head is
+    too short to tell yet, or the format keeps its dimensions elsewhere.
+    """
+    format = sniff(head)
+    if format == 'png' and len(head) >= 24:
+        return _big_endian(head[16:20]), _big_endian(head[20:24])
+    if format == 'gif' and len(head) >= 10:
+        return _little_endian(head[6:8]), _little_endian(head[8:10])
+    if format == 'bmp' and len(head) >= 26:
+        return _little_endian(head[18:22]), \
+               abs(int.from_bytes(head[22:26], 'little', signed=True))
+    if format == 'jpeg':
+        return _jpeg_dimensions(head)
+    if format == 'webp':
+        return _webp_dimensions(head)
+    return None
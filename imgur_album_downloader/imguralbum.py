@@ -15,10 +15,13 @@ Copyright Alex Gisby <alex@solution10.com>
 
 import sys
 import re
-import urllib.request, urllib.parse, urllib.error
 import os
+import json
+import requests
 import math
-from collections import Counter
+import random
+from collections import Counter, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 
 help_message = """
@@ -36,17 +39,110 @@ as the album
 """
 
 
+# An image as listed on the album page. Width, height and size are None when
+# the page doesn't give them.
+AlbumImage = namedtuple("AlbumImage", "hash ext width height size")
+
+# One image object of the album page, from its hash up to its extension.
+IMAGE_PATTERN = re.compile(rb'\{"hash":"([a-zA-Z0-9]+)"(.*?)"ext":"(\.[a-zA-Z0-9]+)"', re.S)
+IMAGE_START = b'{"hash":"'
+IMAGE_FIELDS = [(name, re.compile(rb'"' + name.encode("ascii") + rb'":(\d+)'))
+                for name in ("width", "height", "size")]
+# The number of images, if the page gives it before listing them.
+COUNT_PATTERN = re.compile(rb'"(?:count|num_images|images_count)":(\d+)\D')
+CHUNK_SIZE = 16384
+
+
+class AlbumParser:
+    """
+    Pulls the images out of the album page as it arrives, one chunk at a time,
+    so the page never has to be read and decoded in full. Only the part of the
+    page that hasn't been matched yet is kept.
+    """
+    def __init__(self):
+        self.images = []
+        self.count = None
+        self.buffer = b""
+
+
+    def feed(self, chunk):
+        """
+        Parses the next chunk of the page. Returns the number of images found
+        in it; they are appended to self.images.
+        """
+        self.buffer += chunk
+        found = len(self.images)
+        pos = 0
+        while True:
+            match = IMAGE_PATTERN.search(self.buffer, pos)
+            if not match:
+                break
+            if not self.images:
+                self._read_count(self.buffer[:match.start()])
+            self.images.append(self._record(match))
+            pos = match.end()
+
+        # Keep the start of an image that isn't complete yet, or else a tail
+        # long enough to hold the start of the next one.
+        start = self.buffer.find(IMAGE_START, pos)
+        if not self.images:
+            self._read_count(self.buffer[:start] if start >= 0 else self.buffer)
+        if start < 0:
+            start = max(pos, len(self.buffer) - 32)
+        self.buffer = self.buffer[start:]
+        return len(self.images) - found
+
+
+    def _read_count(self, text):
+        if self.count is None:
+            match = COUNT_PATTERN.search(text)
+            if match:
+                self.count = int(match.group(1))
+
+
+    @staticmethod
+    def _record(match):
+        fields = match.group(2)
+        values = []
+        for name, pattern in IMAGE_FIELDS:
+            value = pattern.search(fields)
+            values.append(int(value.group(1)) if value else None)
+        return AlbumImage(match.group(1).decode("ascii"),
+                          match.group(3).decode("ascii"), *values)
+
+
 class ImgurAlbumException(Exception):
     def __init__(self, msg=False):
         self.msg = msg
 
 
 class ImgurAlbumDownloader:
-    def __init__(self, album_url):
+    def __init__(self, album_url, session=None, retrieve=None, cache_dir=None,
+                 random_image=False):
         """
         Constructor. Pass in the album_url that you want to download.
+
+        Pass in a requests session to share its pooled, keep-alive connections
+        with the rest of your program; otherwise a new one is created.
+
+        Pass in retrieve(image_url, path) to take over downloading single
+        images, e.g. to resume interrupted downloads. It must only create path
+        once the image is complete.
+
+        Pass in cache_dir to keep the image list of every album read there.
+        The album page is then revalidated with a conditional request, and if
+        imgur reports it unchanged the list is loaded from the cache instead.
+
+        Pass in random_image if you only want one image, picked at random. If
+        the album page says how many images there are, it is then only read
+        up to the one picked; see chosen_index().
         """
         self.album_url = album_url
+        self.session = session if session is not None else requests.Session()
+        self.retrieve = retrieve if retrieve is not None else self._retrieve
+        self.chosen = None
+        self.complete = True
+        self.count = None
 
         # Callback members:
         self.image_callbacks = []
@@ -61,34 +157,129 @@ class ImgurAlbumDownloader:
         self.album_key = match.group(4)
 
         # Read the no-script version of the page for all the images:
-        fullListURL = "http://imgur.com/a/" + self.album_key + "/layout/blog"
+        fullListURL = "https://imgur.com/a/" + self.album_key + "/layout/blog"
+
+        cached = self._read_cache(cache_dir)
+        headers = {}
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
 
         try:
-            self.response = urllib.request.urlopen(url=fullListURL)
-            response_code = self.response.getcode()
-        except Exception as e:
+            self.response = self.session.get(fullListURL, headers=headers, stream=True)
+            response_code = self.response.status_code
+        except requests.RequestException:
             self.response = False
-            response_code = e.code
+            response_code = 0
 
-        if not self.response or self.response.getcode() != 200:
-            raise ImgurAlbumException("Error reading Imgur: Error Code %d" % response_code)
+        if self.response is not False and response_code == 304 and cached:
+            # Unchanged since we last read it:
+            self.response.close()
+            self.imageIDs = [AlbumImage(*(list(image) + [None] * 3)[:5])
+                             for image in cached["images"]]
+        else:
+            if not self.response or response_code != 200:
+                if self.response:
+                    self.response.close()
+                raise ImgurAlbumException("Error reading Imgur: Error Code %d" % response_code)
+
+            # Read in the images now so we can get stats and stuff:
+            try:
+                self._read_images(random_image)
+            except requests.RequestException as e:
+                raise ImgurAlbumException("Error reading Imgur: %s" % e)
+            finally:
+                self.response.close()
+            if self.complete:
+                self._write_cache(cache_dir)
 
-        # Read in the images now so we can get stats and stuff:
-        html = self.response.read().decode('utf-8')
-        self.imageIDs = re.findall('.*?{"hash":"([a-zA-Z0-9]+)".*?"ext":"(\.[a-zA-Z0-9]+)".*?', html)
-        
         self.cnt = Counter()
         for i in self.imageIDs:
             self.cnt[i[1]] += 1
 
 
+    def _read_images(self, random_image):
+        """
+        Parses the album page as it streams in. When one random image is
+        wanted and the page gives the number of images first, parsing stops
+        at the image picked, leaving the list incomplete.
+        """
+        parser = AlbumParser()
+        for chunk in self.response.iter_content(CHUNK_SIZE):
+            parser.feed(chunk)
+            if random_image and self.chosen is None and parser.count:
+                self.count = parser.count
+                self.chosen = random.randint(1, parser.count)
+            if self.chosen is not None and len(parser.images) >= self.chosen:
+                self.complete = False
+                break
+        self.imageIDs = parser.images
+        if self.complete and self.chosen is not None and self.chosen > len(self.imageIDs):
+            # the page promised more images than it listed
+            self.chosen = None
+
+
+    def _cache_path(self, cache_dir):
+        return os.path.join(cache_dir, self.album_key + ".json")
+
+
+    def _read_cache(self, cache_dir):
+        """
+        Returns what was cached about this album, or an empty dict.
+        """
+        if not cache_dir:
+            return {}
+        try:
+            with open(self._cache_path(cache_dir), 'r') as input:
+                return json.load(input)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _write_cache(self, cache_dir):
+        """
+        Caches the image list along with the validators of the response.
+        Nothing is cached if imgur sent no validators to revalidate with.
+        """
+        etag = self.response.headers.get("ETag")
+        last_modified = self.response.headers.get("Last-Modified")
+        if not cache_dir or not (etag or last_modified):
+            return
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        path = self._cache_path(cache_dir)
+        with open(path + ".tmp", 'w') as out:
+            json.dump({
+                "etag": etag,
+                "last_modified": last_modified,
+                "images": self.imageIDs,
+            }, out)
+        os.replace(path + ".tmp", path)
+
+
     def num_images(self):
         """
         Returns the number of images that are present in this album.
         """
+        if not self.complete:
+            return self.count
         return len(self.imageIDs)
 
 
+    def chosen_index(self):
+        """
+        Returns the 1-indexed position of a random image, to pass to save(),
+        or 0 if the album is empty. It is the image parsing stopped at, if it
+        stopped early.
+        """
+        if self.chosen is None and self.imageIDs:
+            self.chosen = random.randint(1, len(self.imageIDs))
+        return self.chosen or 0
+
+
     def list_extensions(self):
         """
         Returns list with occurrences of extensions in descending order.
@@ -107,8 +298,9 @@ class ImgurAlbumDownloader:
     def on_image_download(self, callback):
         """
         Allows you to bind a function that will be called just before an image is
-        about to be downloaded. You'll be given the 1-indexed position of the image, it's URL
-        and it's destination file in the callback like so:
+        about to be downloaded. Callbacks run in album order on the thread that called
+        save(), even when several images download at once. You'll be given the 1-indexed
+        position of the image, it's URL and it's destination file in the callback like so:
             my_awesome_callback(1, "http://i.imgur.com/fGWX0.jpg", "~/Downloads/1-fGWX0.jpg")
         """
         self.image_callbacks.append(callback)
@@ -122,7 +314,7 @@ class ImgurAlbumDownloader:
         self.complete_callbacks.append(callback)
 
 
-    def save(self, foldername=False, idx=0):
+    def save(self, foldername=False, idx=0, workers=4):
         """
         Saves the images from the album into a folder given by foldername.
         If no foldername is given, it'll use the cwd and the album key.
@@ -131,6 +323,14 @@ class ImgurAlbumDownloader:
         If counter is 0, downloads all images. Otherwise, it will try to
         download a specific image, if that image is within the gallery's
         range.
+
+        Up to workers images are downloaded at once. The image callbacks are
+        still run in album order, just before each image is queued, and the
+        complete callbacks run once every download has finished.
+
+        Returns the outcome of every image it tried to save, in album order,
+        as (path, error) tuples: error is None if the image was saved or
+        already existed, and otherwise the exception its download raised.
         """
         # Try and create the album folder:
         if foldername:
@@ -141,41 +341,73 @@ class ImgurAlbumDownloader:
         if not os.path.exists(albumFolder):
             os.makedirs(albumFolder)
         
-        if idx > 0 and not idx < len(self.imageIDs):
+        if idx > 0 and not idx <= len(self.imageIDs):
             print("ID specified isn't in gallery's range.")
             idx = 0
 
         # And finally loop through and save the images:
-        for (counter, image) in enumerate(self.imageIDs, start=1):
-            if idx > 0 and not counter == idx:
-                continue
-        
-            image_url = "http://i.imgur.com/"+image[0]+image[1]
-
-            prefix = "%0*d-" % (
-                int(math.ceil(math.log(len(self.imageIDs) + 1, 10))),
-                counter
-            )
-            path = os.path.join(albumFolder, prefix + image[0] + image[1])
-
-            # Run the callbacks:
-            for fn in self.image_callbacks:
-                fn(counter, image_url, path)
-
-            # Actually download the thing
-            if os.path.isfile(path):
-                print ("Skipping, already exists.")
-            else:
-                try:
-                    urllib.request.urlretrieve(image_url, path)
-                except:
-                    print ("Download failed.")
-                    os.remove(path)
+        outcomes = []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            for (counter, image) in enumerate(self.imageIDs, start=1):
+                if idx > 0 and not counter == idx:
+                    continue
+            
+                image_url = "https://i.imgur.com/"+image[0]+image[1]
+
+                prefix = "%0*d-" % (
+                    int(math.ceil(math.log(self.num_images() + 1, 10))),
+                    counter
+                )
+                path = os.path.join(albumFolder, prefix + image[0] + image[1])
+
+                # Run the callbacks:
+                for fn in self.image_callbacks:
+                    fn(counter, image_url, path)
+
+                # Actually download the thing
+                if os.path.isfile(path):
+                    print ("Skipping, already exists.")
+                    outcomes.append((path, None))
+                else:
+                    outcomes.append((path, pool.submit(self._download, image_url, path)))
 
         # Run the complete callbacks:
         for fn in self.complete_callbacks:
             fn()
 
+        return [(path, error if error is None else error.result())
+                for (path, error) in outcomes]
+
+
+    def _download(self, image_url, path):
+        """
+        Downloads a single image to path. Runs on one of save's workers.
+        Returns the exception the download raised, or None if it succeeded.
+        """
+        try:
+            self.retrieve(image_url, path)
+        except Exception as e:
+            return e
+        return None
+
+
+    def _retrieve(self, image_url, path):
+        """
+        Default way of downloading an image. Writes to a temp file first so
+        a failed download never leaves a truncated image at path.
+        """
+        part = path + ".part"
+        try:
+            with self.session.get(image_url, stream=True) as response:
+                response.raise_for_status()
+                with open(part, 'wb') as handle:
+                    for block in response.iter_content(65536):
+                        handle.write(block)
+            os.replace(part, path)
+        finally:
+            if os.path.isfile(part):
+                os.remove(part)
+
 
 if __name__ == '__main__':
     args = sys.argv
@@ -213,8 +445,10 @@ if __name__ == '__main__':
             albumFolder = False
 
         # Enough talk, let's save!
-        downloader.save(albumFolder)
-        exit()
+        failed = [path for (path, error) in downloader.save(albumFolder) if error is not None]
+        for path in failed:
+            print(("Download failed: %s" % path))
+        exit(1 if failed else 0)
 
     except ImgurAlbumException as e:
         print(("Error: " + e.msg))
@@ -4,18 +4,90 @@
 #
 
 import os
+import json
+import store
 import shutil
 import pickle
 import datetime
 import configparser
 from data import Data
 from ast import literal_eval
-from gui import config_gui
-from tkinter import messagebox
-from win32com.client import Dispatch
+
+# the GUI and COM modules are slow to import and only needed by the installer,
+# so they are imported where they are used; see backgrounder.run
 
 VERSION = '0.7'
 MIN_RUN_TIME = 300 # min five minutes between runs
+LEGACY_DATA_FILE = 'data.pkl' # where save data was kept before the store
+CONFIG_FILE = 'backgrounder.ini'
+CONFIG_CACHE_FILE = 'backgrounder.ini.cache'
+
+_config = None # (stamp, configdata) of the settings read last
+
+class ConfigError(Exception):
+    """
+    Raised instead of asking the user to fix backgrounder.ini when it can't
+    be used and the program runs unattended, e.g. with --daemon.
+    """
+    pass
+
+# Sections added after the installer was written. They aren't asked for by the
+# GUI, so older ini files and fresh installs fall back to these defaults.
+# Each setting maps to (default, type, minimum); a minimum of None isn't checked.
+OPTIONAL_SECTIONS = {
+    'download' : '# download performance options',
+    'filter' : '# only keep images within these limits, 0 means no limit',
+    'store' : '# sizing of the filters in front of the save data',
+    'schedule' : '# options for running in the background with --daemon',
+    'endpoints' : '# where to send requests instead, e.g. to fakeserver.py; empty for the real hosts',
+    'metrics' : '# where to write the metrics of each run, empty to skip',
+    'logging' : '# the log is written as JSON lines and rotated by size',
+}
+OPTIONAL_SETTINGS = {
+    'download' : {
+        'workers' : ('4', int, 1), # max number of posts downloaded at once
+        'check_workers' : ('0', int, 0), # processes decoding images, 0 for one per core
+        'dedupe_workers' : ('2', int, 1), # max number of duplicate lookups at once
+        'store_workers' : ('1', int, 1), # max number of images stored at once
+        'queue_size' : ('16', int, 1), # max number of posts waiting for each step
+        'listing_workers' : ('8', int, 1), # max number of listings fetched at once
+        'listing_timeout' : ('30', int, 1), # seconds before a listing is given up on
+        'posts_per_listing' : ('1', int, 1), # top posts taken from each subreddit
+        'album_workers' : ('4', int, 1), # max number of album images downloaded at once
+        'pool_connections' : ('10', int, 1), # number of hosts to keep connections to
+        'pool_maxsize' : ('10', int, 1), # min number of connections kept alive per host
+    },
+    'filter' : {
+        'min_width' : ('0', int, 0), # pixels
+        'min_height' : ('0', int, 0),
+        'max_width' : ('0', int, 0),
+        'max_height' : ('0', int, 0),
+        'min_aspect' : ('0', float, 0), # width / height
+        'max_aspect' : ('0', float, 0),
+        'min_bytes' : ('0', int, 0), # file size
+        'max_bytes' : ('0', int, 0),
+    },
+    'store' : {
+        'filter_capacity' : ('100000', int, 1000), # keys before a filter is rebuilt
+        'filter_error_rate' : ('0.001', float, 0.000001), # false-positive rate
+    },
+    'schedule' : {
+        'jitter' : ('60', int, 0), # max random seconds added to each wait
+    },
+    'endpoints' : {
+        'reddit' : ('', str, None), # base url of the Reddit API
+        'media' : ('', str, None), # base url image and album requests are sent to
+    },
+    'metrics' : {
+        'prometheus_file' : ('metrics.prom', str, None), # replaced every run
+        'summary_file' : ('metrics.jsonl', str, None), # a JSON line per run
+    },
+    'logging' : {
+        'file' : ('backgrounder.log', str, None),
+        'max_bytes' : ('5242880', int, 1024), # size at which the log is rotated
+        'backups' : ('3', int, 0), # number of rotated logs kept
+    },
+}
 
 def create_shortcut(dat):
     """
@@ -33,6 +105,7 @@ def create_shortcut(dat):
         raise Exception('Could not find start path. Aborting')
     
     # Create shortcut to script
+    from win32com.client import Dispatch
     shell = Dispatch('WScript.Shell')
     execpath = os.getcwd() + '\\backgrounder_v' + VERSION + '.exe'
     shortcut = shell.CreateShortcut(startpath + '\\backgrounder_v' + VERSION + '.lnk')
@@ -87,7 +160,16 @@ def write_config_file(configdata):
     config.set('other', 'ignore_duplicates', str(other['ignore_duplicates']))
     config.set('other', 'download_gallery', str(other['download_gallery']))
     
-    with open ('backgrounder.ini', 'w') as file:
+    # optional preferences
+    
+    for section, settings in OPTIONAL_SETTINGS.items():
+        values = configdata.get(section, {})
+        config.add_section(section)
+        config.set(section, OPTIONAL_SECTIONS[section])
+        for key, (default, type, minimum) in settings.items():
+            config.set(section, key, str(values.get(key, default)))
+    
+    with open (CONFIG_FILE, 'w') as file:
         config.write(file)
 
 def validate_config(configdata):
@@ -132,6 +214,19 @@ def validate_config(configdata):
     for key, val in other.items():
         if not (val == '0' or val == '1'):
             dict['other'] = False
+    
+    # make sure optional settings parse and are in range; missing ones are
+    # filled in with their defaults later
+    for section, settings in OPTIONAL_SETTINGS.items():
+        dict[section] = True
+        values = configdata.get(section, {})
+        for key, (default, type, minimum) in settings.items():
+            try:
+                value = type(values.get(key, default))
+                if minimum is not None and value < minimum:
+                    dict[section] = False
+            except ValueError:
+                dict[section] = False
             
     return dict
 
@@ -142,35 +237,135 @@ def process_configdata(configdata):
     """
     configdata['subreddits'] = literal_eval(configdata['subreddits'])
     configdata['postsave'] = int(configdata['postsave'])
+    configdata['timing'] = int(configdata['timing'])
     configdata['other']['ignore_duplicates'] = int(configdata['other']['ignore_duplicates'])
     configdata['other']['download_gallery'] = int(configdata['other']['download_gallery'])
     
+    fill_optional_settings(configdata)
+    
+    return configdata
+
+def fill_optional_settings(configdata):
+    """
+    Fills in defaults for optional settings that configdata lacks, e.g. save
+    data written by an earlier version, and brings the rest into their types.
+    """
+    for section, settings in OPTIONAL_SETTINGS.items():
+        values = configdata.setdefault(section, {})
+        for key, (default, type, minimum) in settings.items():
+            values[key] = type(values.get(key, default))
+    
+    return configdata
+
+def config_stamp():
+    """
+    Returns the (mtime, size) of backgrounder.ini, which identifies its
+    contents, or None if there is no such file.
+    """
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def config_changed():
+    """Returns True if backgrounder.ini changed since it was last read."""
+    return _config is None or _config[0] != config_stamp()
+
+def read_config_file(interactive=True):
+    """
+    Reads the backgrounder.ini file and imports settings from it.
+    
+    The processed settings are cached in memory and in backgrounder.ini.cache,
+    keyed by the ini file's modification time and size, so the file is only
+    parsed and validated again once it changes. The returned configdata is
+    shared between calls and must not be modified.
+    
+    See parse_config_file for interactive.
+    """
+    global _config
+    
+    stamp = config_stamp()
+    if _config is not None and _config[0] == stamp:
+        return _config[1]
+    
+    configdata = read_config_cache(stamp)
+    if configdata is None:
+        configdata = parse_config_file(interactive)
+        if configdata is None:
+            return None
+        write_config_cache(stamp, configdata)
+    
+    _config = (stamp, configdata)
     return configdata
 
-def read_config_file():
-    """Reads the backgrounder.ini file and imports settings from it."""
+def read_config_cache(stamp):
+    """Returns the cached settings if they belong to stamp, otherwise None."""
+    try:
+        with open(CONFIG_CACHE_FILE, 'rb') as input:
+            cache = pickle.load(input)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    
+    if cache.get('version') != VERSION or cache.get('stamp') != stamp:
+        return None
+    configdata = cache['configdata']
+    if not os.path.isdir(configdata['path']['image']):
+        # let the full validation complain about it
+        return None
+    return fill_optional_settings(configdata)
+
+def write_config_cache(stamp, configdata):
+    """Caches processed settings for the ini file identified by stamp."""
+    cache = {'version': VERSION, 'stamp': stamp, 'configdata': configdata}
+    try:
+        with open(CONFIG_CACHE_FILE + '.tmp', 'wb') as out:
+            pickle.dump(cache, out, pickle.HIGHEST_PROTOCOL)
+        os.replace(CONFIG_CACHE_FILE + '.tmp', CONFIG_CACHE_FILE)
+    except OSError:
+        pass # the ini file will just be parsed again next time
+
+def parse_config_file(interactive=True):
+    """
+    Parses, validates and processes the backgrounder.ini file.
     
-    MIN_RUN_TIME = 300 # min five minutes between runs
+    If the file is invalid, the user is told so and None is returned. If
+    interactive is False, ConfigError is raised instead, so nothing is shown
+    to a user who may not be there.
+    """
     
     config = configparser.ConfigParser(allow_no_value=True)
     configdata = {}
     
-    config.read('backgrounder.ini')
-    
-    configdata['path'] = {}
-    configdata['path']['image'] = config['path']['image']
-    configdata['subreddits'] = config['subreddits']['subreddits']
-    configdata['postsave'] = config['postsave']['method']
-    configdata['timing'] = config['timing']['seconds']
-    configdata['other'] = {}
-    configdata['other']['ignore_duplicates'] = config['other']['ignore_duplicates']
-    configdata['other']['download_gallery'] = config['other']['download_gallery']
+    try:
+        config.read(CONFIG_FILE)
+        
+        configdata['path'] = {}
+        configdata['path']['image'] = config['path']['image']
+        configdata['subreddits'] = config['subreddits']['subreddits']
+        configdata['postsave'] = config['postsave']['method']
+        configdata['timing'] = config['timing']['seconds']
+        configdata['other'] = {}
+        configdata['other']['ignore_duplicates'] = config['other']['ignore_duplicates']
+        configdata['other']['download_gallery'] = config['other']['download_gallery']
+    except (configparser.Error, KeyError) as e:
+        if interactive:
+            raise
+        raise ConfigError('could not read backgrounder.ini: %r' % e)
+    
+    for section, settings in OPTIONAL_SETTINGS.items():
+        configdata[section] = {}
+        for key, (default, type, minimum) in settings.items():
+            configdata[section][key] = config.get(section, key, fallback=default)
     
     # validate user-entered config
     valid_dict = validate_config(configdata)
     for key, val in valid_dict.items():
         if val is False:
-            messagebox.showinfo('Warning', 'There was an error reading backgrounder.ini.\n\nPlease delete your data.pkl file and rerun the program.'
+            if not interactive:
+                raise ConfigError('invalid [%s] section in backgrounder.ini' % key)
+            from tkinter import messagebox
+            messagebox.showinfo('Warning', 'There was an error reading the [%s] section of backgrounder.ini.\n\nPlease fix or delete the file and rerun the program.'
                 % (key))
             return None
     
@@ -180,6 +375,7 @@ def read_config_file():
     
 def install(DEBUG):
     """Runs installation procedures."""
+    from gui import config_gui
     dat = Data()
     GUI = config_gui.Config_GUI()
     
@@ -200,45 +396,89 @@ def install(DEBUG):
     write_config_file(dat.configdata)
     
     dat.userdata['image_id'] = 0
-    dat.userdata['imgur_galleries'] = set()
+    dat.userdata['imgur_galleries'] = store.GallerySet(store.get_store())
     
     create_shortcut(dat) # TODO : make this optional
     
     return dat
 
-def read_data(DEBUG):
+def migrate_data(db):
+    """
+    Moves the save data pickled by earlier versions into the store. The old
+    file is kept as data.pkl.migrated.
+    """
+    with open(LEGACY_DATA_FILE, 'rb') as input:
+        dat = pickle.load(input)
+    
+    db.set_meta('image_id', dat.userdata['image_id'])
+    db.set_meta('configdata', json.dumps(dat.configdata))
+    db.add_galleries(dat.userdata['imgur_galleries'])
+    db.commit()
+    
+    os.replace(LEGACY_DATA_FILE, LEGACY_DATA_FILE + '.migrated')
+
+def read_data(DEBUG, interactive=True):
     """
     Reads and returns save data. If no save data exists, runs and returns the
     result of the installation procedure.
     
+    Only the small values are read here; visited galleries and the like stay
+    in the store and are queried when needed.
+    
+    If interactive is False, an invalid backgrounder.ini raises ConfigError
+    instead of being reported to the user.
+    
     return: a Dat object representing all user save and configuration data
     """    
-    if os.path.isfile('data.pkl'):
-        with open('data.pkl', 'rb') as input:
-            dat = pickle.load(input)
-            # use user config file if that file exists
-            if os.path.isfile('backgrounder.ini'):
-                configdata = read_config_file()
-                if configdata:
-                    # config was found and is valid
-                    dat.configdata = configdata
-                else:
-                    # config was found, but is invalid
-                    quit() # FIXME getting some funky bugs when I try to rerun the installer
-            else:
-                # config was not found, write previous data
-                write_config_file(dat.configdata)
-            return dat
-    else:
+    db = store.get_store()
+    if db.get_meta('image_id') is None and os.path.isfile(LEGACY_DATA_FILE):
+        migrate_data(db)
+    
+    if db.get_meta('image_id') is None:
         return install(DEBUG)
+    
+    dat = Data()
+    dat.userdata['image_id'] = int(db.get_meta('image_id'))
+    dat.userdata['imgur_galleries'] = store.GallerySet(db)
+    dat.configdata = fill_optional_settings(json.loads(db.get_meta('configdata')))
+    dat.configdata['timing'] = int(dat.configdata['timing'])
+    
+    # use user config file if that file exists
+    if os.path.isfile(CONFIG_FILE):
+        configdata = read_config_file(interactive)
+        if configdata:
+            # config was found and is valid
+            dat.configdata = configdata
+        else:
+            # config was found, but is invalid
+            quit() # FIXME getting some funky bugs when I try to rerun the installer
+    else:
+        # config was not found, write previous data
+        write_config_file(dat.configdata)
+    
+    db.configure_filters(dat.configdata['store']['filter_capacity'],
+                         dat.configdata['store']['filter_error_rate'])
+    return dat
 
-def write_data(dat):
-    """Writes save data to disk. Overwrites any existing data."""
-    with open('data.pkl', 'wb') as out:
-        pickle.dump(dat, out, pickle.HIGHEST_PROTOCOL)
+def write_data(dat, run=None):
+    """
+    Writes the save data that changed to disk, in a single transaction.
+    
+    Arguments:
+        dat -- save data
+        run -- optional (started, finished, posts, saved) tuple describing
+               this run, which is added to the run history
+    """
+    db = store.get_store()
+    db.set_meta('image_id', dat.userdata['image_id'])
+    db.set_meta('configdata', json.dumps(dat.configdata))
+    if run is not None:
+        db.record_run(*run)
+    db.commit()
     
 def main():
     """Runs the GUI and reports what the user enters, for debugging."""
+    from gui import config_gui
     
     configdata = config_gui.Config_GUI().activate()
     
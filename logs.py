@@ -0,0 +1,111 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# logging setup: JSON lines, written by a background thread, rotated by size
+#
+
+import copy
+import json
+import queue
+import atexit
+import logging
+import datetime
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOGGER_NAME = 'backgrounder'
+LOG_FILE = 'backgrounder.log'
+MAX_BYTES = 5242880 # size at which the log is rotated
+BACKUP_COUNT = 3 # number of rotated logs kept
+
+# extra attributes of a record that are written out when present, e.g.
+# log.info(message, extra={'post' : post.id, 'result' : 'no_error'})
+FIELDS = ('post', 'subreddit', 'url', 'path', 'bytes', 'duration', 'result')
+
+_listener = None
+_lock = threading.Lock()
+
+class JsonFormatter(logging.Formatter):
+    """Formats every record as a single line of JSON."""
+    def format(self, record):
+        entry = {
+            'time' : datetime.datetime.fromtimestamp(record.created).isoformat(),
+            'level' : record.levelname,
+            'message' : record.getMessage(),
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RecordQueueHandler(QueueHandler):
+    """
+    Puts records on the listener's queue. QueueHandler would merge a record's
+    traceback into its message; this keeps it apart, as exc_text, so the
+    JsonFormatter writes it to its own field.
+    """
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            # the traceback itself would keep every frame alive in the queue
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+def configure(filename=LOG_FILE, max_bytes=MAX_BYTES, backups=BACKUP_COUNT):
+    """
+    Sets up the program's logger, once per process; later calls change
+    nothing.
+
+    Records are put on a queue and written by a listener thread, so logging
+    never waits on the disk. The log is written as JSON lines and rotated
+    once it grows past max_bytes, keeping backups old logs. Nothing is
+    written if filename is empty.
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        if filename:
+            handler = RotatingFileHandler(filename, maxBytes=max_bytes,
+                                          backupCount=backups, encoding='utf-8',
+                                          delay=True)
+        else:
+            handler = logging.NullHandler()
+        handler.setFormatter(JsonFormatter())
+        records = queue.Queue()
+
+        logger = logging.getLogger(LOGGER_NAME)
+        logger.setLevel(logging.INFO)
+        logger.addHandler(RecordQueueHandler(records))
+
+        _listener = QueueListener(records, handler)
+        _listener.start()
+        atexit.register(shutdown)
+
+def shutdown():
+    """Writes out the records still queued and stops the listener."""
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+        logger = logging.getLogger(LOGGER_NAME)
+        for handler in list(logger.handlers):
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+
+def get_logger():
+    """Returns the program's logger, setting it up with defaults if needed."""
+    configure()
+    return logging.getLogger(LOGGER_NAME)
@@ -0,0 +1,145 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# per-run counters and timings, exported for monitoring
+#
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+PREFIX = 'backgrounder_'
+
+_lock = threading.Lock()
+_counters = {} # (name, labels) -> value
+_timings = {} # (name, labels) -> [count, sum, max]
+_gauges = {} # (name, labels) -> value
+_started = time.time()
+
+def _key(name, labels):
+    return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def reset():
+    """Starts a new run; everything recorded so far is dropped."""
+    global _started
+    with _lock:
+        _counters.clear()
+        _timings.clear()
+        _gauges.clear()
+        _started = time.time()
+
+def count(name, value=1, **labels):
+    """Adds value to a counter, e.g. count('posts_total', result='no_error')."""
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def gauge(name, value, **labels):
+    """Sets a value that isn't accumulated, such as a size."""
+    with _lock:
+        _gauges[_key(name, labels)] = value
+
+def observe(name, seconds, **labels):
+    """Records how long something took."""
+    key = _key(name, labels)
+    with _lock:
+        timing = _timings.setdefault(key, [0, 0.0, 0.0])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2] = max(timing[2], seconds)
+
+@contextmanager
+def timer(name, **labels):
+    """Records how long the body of a with statement takes, even if it raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started, **labels)
+
+def hit_rate(name):
+    """
+    Returns the share of a counter with result='hit' among those with
+    result='hit' or 'miss', or None if neither was counted.
+    """
+    hits = misses = 0
+    with _lock:
+        for (counter, labels), value in _counters.items():
+            if counter != name:
+                continue
+            result = dict(labels).get('result')
+            if result == 'hit':
+                hits += value
+            elif result == 'miss':
+                misses += value
+    return hits / float(hits + misses) if hits + misses else None
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"') \
+                                .replace('\n', '\\n')
+    return '{' + ','.join('%s="%s"' % (key, escape(value))
+                          for key, value in labels) + '}'
+
+def prometheus_text():
+    """Returns everything recorded in the Prometheus text exposition format."""
+    lines = []
+    def family(name, kind, samples):
+        lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+        for suffix, labels, value in samples:
+            lines.append('%s%s%s%s %r' % (PREFIX, name, suffix,
+                                          _label_text(labels), value))
+
+    with _lock:
+        for kind, values in (('counter', _counters), ('gauge', _gauges)):
+            for name in sorted(set(name for name, labels in values)):
+                family(name, kind, [('', labels, values[(other, labels)])
+                                    for other, labels in sorted(values)
+                                    if other == name])
+        for name in sorted(set(name for name, labels in _timings)):
+            samples = []
+            for other, labels in sorted(_timings):
+                if other != name:
+                    continue
+                number, total, longest = _timings[(other, labels)]
+                samples.append(('_count', labels, number))
+                samples.append(('_sum', labels, total))
+            family(name, 'summary', samples)
+        family('run_started_seconds', 'gauge', [('', (), _started)])
+    return '\n'.join(lines) + '\n'
+
+def summary():
+    """Returns everything recorded as a dict that can be dumped as JSON."""
+    def entries(values, convert):
+        return [dict(labels, name=name, **convert(value))
+                for (name, labels), value in sorted(values.items())]
+
+    with _lock:
+        result = {
+            'started' : _started,
+            'finished' : time.time(),
+            'counters' : entries(_counters, lambda value: {'value' : value}),
+            'gauges' : entries(_gauges, lambda value: {'value' : value}),
+            'timings' : entries(_timings, lambda value: {
+                'count' : value[0], 'sum' : value[1], 'max' : value[2]}),
+        }
+    result['hit_rates'] = {name : hit_rate(name) for name in
+                           set(entry['name'] for entry in result['counters']
+                               if entry.get('result') in ('hit', 'miss'))}
+    return result
+
+def export(prometheus_file=None, summary_file=None):
+    """
+    Writes the metrics of the run. The Prometheus file is replaced, so a
+    textfile collector always sees the last run; the JSON summary is appended
+    as one line per run. Either is skipped if its filename is empty.
+    """
+    if prometheus_file:
+        with open(prometheus_file + '.tmp', 'w') as out:
+            out.write(prometheus_text())
+        os.replace(prometheus_file + '.tmp', prometheus_file)
+    if summary_file:
+        with open(summary_file, 'a') as out:
+            out.write(json.dumps(summary(), sort_keys=True) + '\n')
@@ -0,0 +1,139 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# staged processing of items on worker threads connected by bounded queues
+#
+
+import queue
+import metrics
+import threading
+
+QUEUE_SIZE = 16 # max number of items waiting in front of a stage
+
+_STOP = object() # tells a worker to exit
+_END = object() # marks the end of the source
+
+class Item():
+    """
+    Base class of the items sent through a pipeline.
+
+    An item whose result is set skips the remaining stages. If a stage raises,
+    the exception is stored in error and the item skips the remaining stages
+    as well.
+    """
+    def __init__(self):
+        self.result = None
+        self.error = None
+
+class Stage():
+    """
+    One step of a pipeline. function(item) is called for every item that
+    reaches the stage, on up to workers threads at once, and processes the
+    item in place.
+    """
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+
+class Pipeline():
+    """
+    Runs items through a sequence of stages.
+
+    Every stage has its own worker threads and a bounded queue in front of it.
+    The time spent in each stage is recorded as stage_seconds in metrics.
+    When a stage falls behind, its queue fills up and the stages before it
+    block until there is room again, so a slow disk or a slow host slows the
+    whole pipeline down instead of letting work in progress pile up in
+    memory. At most the queued items plus one per worker are in flight.
+    """
+    def __init__(self, stages, sink, queue_size=QUEUE_SIZE):
+        """
+        Arguments:
+            stages -- the Stages to run the items through, in order
+            sink -- called with every finished item, whether it went through
+                    all stages or not, in the order they finish
+            queue_size -- max number of items waiting in front of each stage
+        """
+        self.stages = stages
+        self.sink = sink
+        self.queues = [queue.Queue(queue_size) for stage in stages]
+        self.finished = queue.Queue(queue_size)
+
+    def _forward(self, index, item):
+        """Hands item to the stage at index, or to the sink if it's done."""
+        if index == len(self.stages) or item.result is not None or \
+                item.error is not None:
+            self.finished.put(item)
+        else:
+            self.queues[index].put(item)
+
+    def _work(self, index):
+        stage = self.stages[index]
+        while True:
+            item = self.queues[index].get()
+            if item is _STOP:
+                return
+            try:
+                with metrics.timer('stage_seconds', stage=stage.name):
+                    stage.function(item)
+            except Exception as e:
+                item.error = e
+            self._forward(index + 1, item)
+
+    def _feed(self, source, state):
+        count = 0
+        try:
+            for item in source:
+                self._forward(0, item)
+                count += 1
+        except Exception as e:
+            state['error'] = e
+        finally:
+            state['count'] = count
+            self.finished.put(_END)
+
+    def run(self, source):
+        """
+        Sends every item of source through the stages and returns once all of
+        them are finished. source is consumed on a thread of its own, so it
+        may be a generator that produces items while earlier ones are still
+        being processed. The sink is called on the calling thread.
+
+        Returns the number of items processed. Exceptions raised by source or
+        by the sink are raised again once every item is finished.
+        """
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name='%s-%d' % (stage.name, worker),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        state = {}
+        feeder = threading.Thread(target=self._feed, args=(source, state),
+                                  name='source', daemon=True)
+        feeder.start()
+
+        # keep draining even if the sink fails, so no worker stays blocked
+        done = 0
+        while 'count' not in state or done < state['count']:
+            item = self.finished.get()
+            if item is _END:
+                continue
+            done += 1
+            try:
+                self.sink(item)
+            except Exception as e:
+                state.setdefault('error', e)
+
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                self.queues[index].put(_STOP)
+        for thread in threads:
+            thread.join()
+
+        if 'error' in state:
+            raise state['error']
+        return done
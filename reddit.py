@@ -3,40 +3,133 @@
 # file designed to access Reddit via the PRAW API
 #
 
+import os
+import json
+import time
 import praw
+import prawcore
+import threading
 import oauth_info
 
+PRAW_INI = 'praw.ini'
+TOKEN_FILE = 'reddit_token.json'
+TOKEN_MARGIN = 60 # seconds before it expires that a cached token is dropped
+
+_reddit = None
+_endpoint = ''
+_lock = threading.Lock()
+
+class CachedAuthorizer(prawcore.ReadOnlyAuthorizer):
+	"""
+	Application-only authorizer that keeps its access token in a file.
+	
+	praw requests a new token the first time each process talks to Reddit.
+	This authorizer starts out with the token saved by an earlier run instead,
+	as long as that token is still valid, and saves every token it requests,
+	so a token is only requested again once it expires.
+	"""
+	
+	def __init__(self, authenticator, filename=TOKEN_FILE, endpoint=''):
+		super().__init__(authenticator)
+		self.filename = filename
+		self.endpoint = endpoint
+		self.load()
+	
+	def load(self):
+		"""Uses the saved token if there is one that doesn't expire soon."""
+		try:
+			with open(self.filename, 'r') as input:
+				token = json.load(input)
+			if token['client_id'] != self._authenticator.client_id or \
+					token.get('endpoint', '') != self.endpoint:
+				return
+			if token['expires'] - TOKEN_MARGIN <= time.time():
+				return
+			self.access_token = token['access_token']
+			self.scopes = set(token['scopes'])
+			self._expiration_timestamp = token['expires'] - TOKEN_MARGIN
+		except (OSError, ValueError, KeyError, TypeError):
+			pass # a new token will be requested instead
+	
+	def save(self):
+		"""Saves the current token for later runs."""
+		token = {
+			'client_id' : self._authenticator.client_id,
+			'endpoint' : self.endpoint,
+			'access_token' : self.access_token,
+			'scopes' : sorted(self.scopes or ()),
+			'expires' : self._expiration_timestamp,
+		}
+		try:
+			with open(self.filename + '.tmp', 'w') as out:
+				json.dump(token, out)
+			os.replace(self.filename + '.tmp', self.filename)
+		except OSError:
+			pass # the token will just be requested again next run
+	
+	def refresh(self):
+		"""Requests a new token and saves it."""
+		super().refresh()
+		self.save()
+
 class Reddit():
 	"""Class used in order to access Reddit through the PRAW API."""
 	
 	def __init__(self):
-		"""Initializes and returns the Reddit object."""	
-		# Secret info is packaged into executable
-		self.write_praw_ini()
-		reddit = praw.Reddit(client_id=oauth_info.client_id,
-							 client_secret=oauth_info.client_secret,
-							 redirect_uri=oauth_info.redirect_uri,
-							 user_agent=oauth_info.user_agent)
-		reddit.read_only = True
-		self.reddit = reddit
-	
-	def write_praw_ini(self):
-		"""
-		Creates a praw.ini file if one does not already exist.
-		
-		The Python-Reddit API Wrapper (PRAW) requires a .ini file in order to run.
-		If that file is not present, the executable will fail. This function writes
-		that file out for the user if it is not present (as I am not tempted to dig
-		into Pyinstaller to figure out why it isn't being included in the exe file
-		in the first place). The executable version is temperamental about actually
-		writing the file, so temper with this function at your own risk.
-		
-		For more detail, visit:
-		praw.readthedocs.io/en/latest/getting_started/configuration/prawini.html
-		"""
-		with open('praw.ini', 'w') as out:
-			out.write('[DEFAULT]\ncheck_for_updates=True\ncomment_kind=t1\n')
-			out.write('message_kind=t4\nredditor_kind=t2\nsubmission_kind=t3\n')
-			out.write('subreddit_kind=t5\noauth_url=https://oauth.reddit.com\n')
-			out.write('reddit_url=https://www.reddit.com\n')
-			out.write('short_url=https://redd.it\n')
\ No newline at end of file
+		"""Initializes the object with the shared Reddit client."""
+		self.reddit = get_reddit()
+
+def get_reddit(endpoint=''):
+	"""
+	Returns the Reddit client of this process, creating it on first use.
+	
+	The client is read-only and shared by everything that talks to Reddit,
+	such as the download pipeline and the configuration GUI. Its access token
+	is kept in TOKEN_FILE between runs; see CachedAuthorizer.
+	
+	If endpoint is set, the client sends its requests there instead of to
+	reddit.com, e.g. to fakeserver.py.
+	"""
+	global _reddit, _endpoint
+	with _lock:
+		if _reddit is None or _endpoint != endpoint:
+			# Secret info is packaged into executable
+			write_praw_ini()
+			urls = {}
+			if endpoint:
+				urls['oauth_url'] = urls['reddit_url'] = endpoint.rstrip('/')
+			reddit = praw.Reddit(client_id=oauth_info.client_id,
+								 client_secret=oauth_info.client_secret,
+								 redirect_uri=oauth_info.redirect_uri,
+								 user_agent=oauth_info.user_agent,
+								 **urls)
+			reddit.read_only = True
+			core = reddit._read_only_core
+			core._authorizer = CachedAuthorizer(core._authorizer._authenticator,
+												endpoint=endpoint)
+			_reddit = reddit
+			_endpoint = endpoint
+		return _reddit
+
+def write_praw_ini():
+	"""
+	Creates a praw.ini file if one does not already exist.
+	
+	The Python-Reddit API Wrapper (PRAW) requires a .ini file in order to run.
+	If that file is not present, the executable will fail. This function writes
+	that file out for the user if it is not present (as I am not tempted to dig
+	into Pyinstaller to figure out why it isn't being included in the exe file
+	in the first place). The executable version is temperamental about actually
+	writing the file, so temper with this function at your own risk.
+	
+	For more detail, visit:
+	praw.readthedocs.io/en/latest/getting_started/configuration/prawini.html
+	"""
+	if os.path.isfile(PRAW_INI):
+		return
+	with open(PRAW_INI, 'w') as out:
+		out.write('[DEFAULT]\ncheck_for_updates=True\ncomment_kind=t1\n')
+		out.write('message_kind=t4\nredditor_kind=t2\nsubmission_kind=t3\n')
+		out.write('subreddit_kind=t5\noauth_url=https://oauth.reddit.com\n')
+		out.write('reddit_url=https://www.reddit.com\n')
+		out.write('short_url=https://redd.it\n')
@@ -0,0 +1,83 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# remembers which posts and media urls were processed before
+#
+
+import re
+from urllib.parse import urlsplit
+
+# imgur serves the same image from several hosts and with or without an
+# extension; albums live under both /a/ and /gallery/
+IMGUR_IMAGE = re.compile(r'^/([a-zA-Z0-9]{5,})(\.[a-zA-Z0-9]+)?$')
+IMGUR_ALBUM = re.compile(r'^/(?:a|gallery)/([a-zA-Z0-9]+)')
+# hosts whose query strings only carry things like sizes and signatures; on
+# other hosts, e.g. youtube.com/watch?v=..., the query names the media
+QUERY_FREE_HOSTS = ('i.redd.it', 'preview.redd.it', 'external-preview.redd.it',
+                    'imgur.com', 'i.imgur.com')
+
+def canonical_url(url):
+    """
+    Returns a canonical form of a media url, so that different urls for the
+    same media compare equal. The scheme, 'www.' and 'm.' prefixes, the
+    fragment and trailing slashes are dropped, as is the query string of the
+    hosts in QUERY_FREE_HOSTS, and imgur image and album urls are reduced to
+    their hash.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parts.path.rstrip('/')
+
+    if host in ('imgur.com', 'i.imgur.com'):
+        match = IMGUR_ALBUM.match(path)
+        if match:
+            return 'imgur.com/a/' + match.group(1)
+        match = IMGUR_IMAGE.match(path)
+        if match:
+            return 'imgur.com/' + match.group(1)
+
+    if parts.query and host not in QUERY_FREE_HOSTS:
+        return host + path + '?' + parts.query
+    return host + path
+
+def post_ids(post):
+    """
+    Returns the ids a post is known by: its own, and that of the post it was
+    crossposted from, if any.
+    """
+    ids = [post.id]
+    # praw fetches the whole post when a missing attribute is read, so only
+    # look at what the listing already provided
+    parent = vars(post).get('crosspost_parent')
+    if parent:
+        # fullnames look like t3_<id>
+        ids.append(parent.split('_', 1)[-1])
+    return ids
+
+def is_seen(post, db, batch):
+    """
+    Checks whether a post can be skipped, because it or its media were
+    processed in an earlier run, or because another post in this batch has
+    the same media. Nothing is requested from the media hosts to decide
+    this.
+
+    Arguments:
+        post -- the candidate post
+        db -- the store
+        batch -- the canonical media urls of the posts of this batch that
+                 weren't seen; post's is added to it if post wasn't seen either
+    """
+    url = canonical_url(post.url)
+    if url in batch or db.has_seen_url(url) or \
+            any(db.has_seen_post(id) for id in post_ids(post)):
+        return True
+    batch.add(url)
+    return False
+
+def mark_seen(post, db):
+    """Records that post was processed, so later runs skip it and its media."""
+    for id in post_ids(post):
+        db.add_seen_post(id)
+    db.add_seen_url(canonical_url(post.url))
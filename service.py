@@ -0,0 +1,53 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# runs the program as a Windows service
+#
+
+import socket
+import win32event
+import win32service
+import servicemanager
+import win32serviceutil
+import backgrounder
+
+class AppServerSvc (win32serviceutil.ServiceFramework):
+    """
+    Runs the script as a Windows service. Edited from the original to add 
+    functionality and flexibility.
+    
+    source https://stackoverflow.com/questions/32404/how-do-you-run-a-python-script-as-a-service-in-windows?rq=
+    """
+    _svc_name_ = "Backgrounder"
+    _svc_display_name_ = "Backgrounder"
+
+    def __init__(self, args):
+        win32serviceutil.ServiceFramework.__init__(self,args)
+        socket.setdefaulttimeout(60)
+        
+        self._hWaitStop = win32event.CreateEvent(None,0,0,None)
+
+    def SvcStop(self):
+        self.ReportServiceStatus(win32service.SERVICE_STOP_PENDING)
+        win32event.SetEvent(self._hWaitStop)
+
+    def SvcDoRun(self):
+        servicemanager.LogMsg(servicemanager.EVENTLOG_INFORMATION_TYPE,
+                              servicemanager.PYS_SERVICE_STARTED,
+                              (self._svc_name_,''))
+                
+        rc = None
+        while rc != win32event.WAIT_OBJECT_0:
+            # run, then wait until the next run is due
+            wait = backgrounder.run()
+            if wait is None:
+                break
+            rc = win32event.WaitForSingleObject(self._hWaitStop, int(wait * 1000))
+
+def main(argv):
+    # TODO : https://mail.python.org/pipermail/python-win32/2010-July/010648.html
+    if len(argv) == 1:
+        servicemanager.Initialize()
+        servicemanager.PrepareToHostSingle(AppServerSvc)
+        servicemanager.StartServiceCtrlDispatcher()
+    else:
+        win32serviceutil.HandleCommandLine(AppServerSvc, argv=argv)
@@ -0,0 +1,250 @@
+# author: Paul Galatic github.com/pgalatic
+#
+# SQLite-backed storage for user data
+#
+
+import bloom
+import sqlite3
+import metrics
+import threading
+
+DB_FILE = 'backgrounder.db'
+GALLERY_FILTER_FILE = 'galleries.bloom'
+SEEN_FILTER_FILE = 'seen.bloom'
+
+FILTER_CAPACITY = 100000 # keys a filter is sized for before it's rebuilt
+FILTER_ERROR_RATE = 0.001 # false-positive rate of the filters
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS galleries (
+    url TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS hashes (
+    filename TEXT PRIMARY KEY,
+    mtime REAL,
+    hash INTEGER,
+    width INTEGER,
+    height INTEGER,
+    digest TEXT,
+    band0 INTEGER,
+    band1 INTEGER,
+    band2 INTEGER,
+    band3 INTEGER,
+    band4 INTEGER
+);
+CREATE INDEX IF NOT EXISTS hashes_digest ON hashes (digest);
+CREATE INDEX IF NOT EXISTS hashes_band0 ON hashes (band0);
+CREATE INDEX IF NOT EXISTS hashes_band1 ON hashes (band1);
+CREATE INDEX IF NOT EXISTS hashes_band2 ON hashes (band2);
+CREATE INDEX IF NOT EXISTS hashes_band3 ON hashes (band3);
+CREATE INDEX IF NOT EXISTS hashes_band4 ON hashes (band4);
+CREATE TABLE IF NOT EXISTS seen_posts (
+    id TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS seen_urls (
+    url TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL,
+    finished REAL,
+    posts INTEGER,
+    saved INTEGER
+);
+'''
+
+_store = None
+_lock = threading.Lock()
+
+class Store():
+    """
+    Holds the user data in an SQLite database.
+
+    Nothing is loaded up front; every lookup is an indexed query, and changes
+    are collected in a transaction until commit() is called, so a crash never
+    leaves the data half-written. The connection is shared between threads and
+    guarded by a lock.
+    """
+    def __init__(self, filename=DB_FILE):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.meta = dict(self.query('SELECT key, value FROM meta'))
+        
+        self.filter_capacity = FILTER_CAPACITY
+        self.filter_error_rate = FILTER_ERROR_RATE
+        self.filters = {}
+
+    def configure_filters(self, capacity=FILTER_CAPACITY,
+                          error_rate=FILTER_ERROR_RATE):
+        """
+        Sets the size and false-positive rate of the bloom filters that sit in
+        front of membership checks. Takes effect for filters not opened yet.
+        """
+        self.filter_capacity = capacity
+        self.filter_error_rate = min(error_rate, 0.5)
+
+    def get_filter(self, filename, keys):
+        """
+        Returns the bloom filter stored in filename, opening it on first use.
+        keys() must return every key of the exact set, in case the filter
+        has to be rebuilt.
+        """
+        with self.lock:
+            filter = self.filters.get(filename)
+            if filter is None or filter.is_full():
+                # a filter that outgrew its capacity is rebuilt larger
+                if filter is not None:
+                    filter.close()
+                filter = bloom.open_filter(filename, self.filter_capacity,
+                                           self.filter_error_rate, keys)
+                self.filters[filename] = filter
+            return filter
+
+    def execute(self, sql, params=()):
+        """Runs a statement as part of the current transaction."""
+        with self.lock:
+            self.connection.execute(sql, params)
+
+    def executemany(self, sql, rows):
+        """Runs a statement once for each row in rows."""
+        with self.lock:
+            self.connection.executemany(sql, rows)
+
+    def query(self, sql, params=()):
+        """Runs a query and returns all resulting rows."""
+        with self.lock:
+            return self.connection.execute(sql, params).fetchall()
+
+    def commit(self):
+        """Writes every change made since the last commit in one transaction."""
+        with self.lock:
+            # a filter may claim keys the store lacks, but never the other
+            # way around, so the filters are written first
+            for filter in self.filters.values():
+                filter.flush()
+            self.connection.commit()
+
+    def get_meta(self, key, default=None):
+        return self.meta.get(key, default)
+
+    def set_meta(self, key, value):
+        """Stores a single value. Values that didn't change aren't written."""
+        value = str(value)
+        if self.meta.get(key) == value:
+            return
+        self.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, value))
+        self.meta[key] = value
+
+    def _gallery_filter(self):
+        return self.get_filter(GALLERY_FILTER_FILE, lambda: (
+            row[0] for row in self.query('SELECT url FROM galleries')))
+
+    def _filter_check(self, filter, key, name):
+        """
+        Asks a filter about key and counts whether it spared a query, which
+        is a hit, or not.
+        """
+        present = key in filter
+        metrics.count('bloom_filter_total', filter=name,
+                      result='miss' if present else 'hit')
+        return present
+
+    def has_gallery(self, url):
+        # most urls are new; the filter rules them out without a query
+        if not self._filter_check(self._gallery_filter(), url, 'galleries'):
+            return False
+        return bool(self.query(
+            'SELECT 1 FROM galleries WHERE url = ?', (url,)))
+
+    def add_gallery(self, url):
+        self.execute('INSERT OR IGNORE INTO galleries VALUES (?)', (url,))
+        self._gallery_filter().add(url)
+
+    def add_galleries(self, urls):
+        urls = list(urls)
+        self.executemany('INSERT OR IGNORE INTO galleries VALUES (?)',
+                         ((url,) for url in urls))
+        gallery_filter = self._gallery_filter()
+        for url in urls:
+            gallery_filter.add(url)
+
+    def remove_gallery(self, url):
+        # the filter can't forget the url; the exact check will rule it out
+        self.execute('DELETE FROM galleries WHERE url = ?', (url,))
+
+    def _seen_filter(self):
+        # posts and urls share a filter; their keys are told apart by prefix
+        def keys():
+            for row in self.query('SELECT id FROM seen_posts'):
+                yield 'post:' + row[0]
+            for row in self.query('SELECT url FROM seen_urls'):
+                yield 'url:' + row[0]
+        return self.get_filter(SEEN_FILTER_FILE, keys)
+
+    def has_seen_post(self, id):
+        if not self._filter_check(self._seen_filter(), 'post:' + id, 'seen'):
+            return False
+        return bool(self.query(
+            'SELECT 1 FROM seen_posts WHERE id = ?', (id,)))
+
+    def add_seen_post(self, id):
+        self.execute('INSERT OR IGNORE INTO seen_posts VALUES (?)', (id,))
+        self._seen_filter().add('post:' + id)
+
+    def has_seen_url(self, url):
+        if not self._filter_check(self._seen_filter(), 'url:' + url, 'seen'):
+            return False
+        return bool(self.query(
+            'SELECT 1 FROM seen_urls WHERE url = ?', (url,)))
+
+    def add_seen_url(self, url):
+        self.execute('INSERT OR IGNORE INTO seen_urls VALUES (?)', (url,))
+        self._seen_filter().add('url:' + url)
+
+    def count_galleries(self):
+        return self.query('SELECT COUNT(*) FROM galleries')[0][0]
+
+    def record_run(self, started, finished, posts, saved):
+        """Adds an entry to the run history."""
+        self.execute('INSERT INTO runs (started, finished, posts, saved) '
+                     'VALUES (?, ?, ?, ?)', (started, finished, posts, saved))
+
+    def last_run(self):
+        """Returns (started, finished, posts, saved) of the last run, or None."""
+        rows = self.query('SELECT started, finished, posts, saved FROM runs '
+                          'ORDER BY id DESC LIMIT 1')
+        return rows[0] if rows else None
+
+class GallerySet():
+    """
+    Set-like view of the visited imgur galleries, backed by the store. Stands
+    in for the set that used to be kept in dat.userdata['imgur_galleries'].
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __contains__(self, url):
+        return self.store.has_gallery(url)
+
+    def __len__(self):
+        return self.store.count_galleries()
+
+    def add(self, url):
+        self.store.add_gallery(url)
+
+    def discard(self, url):
+        self.store.remove_gallery(url)
+
+def get_store():
+    """Returns the store of this process, opening it on first use."""
+    global _store
+    with _lock:
+        if _store is None:
+            _store = Store()
+        return _store
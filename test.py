@@ -2,5 +2,429 @@
 #
 # testing utilities, profiling
 #
+# Offline throughput benchmarks of the fetch pipeline. A synthetic corpus of
+# images is generated once and served by a local HTTP server that stands in
+# for i.redd.it and imgur, so the numbers only depend on this machine. The
+# program is pointed at it the same way as at fakeserver.py.
+#
+#   python test.py                   run every benchmark, compare to baseline
+#   python test.py --corpus 100000   use a larger corpus
+#   python test.py --save-baseline   store the results as the new baseline
+#
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import fakeserver
+import http.server
+from urllib.parse import urlsplit
+
+CORPUS_DIR = 'bench_corpus'
+BASELINE_FILE = 'bench_baseline.json'
+TOLERANCE = 0.25 # how much worse than the baseline a metric may get
+SEED = 1
+
+# (width, height) of the generated images, and how often each occurs
+SIZES = [(320, 240), (640, 480), (1280, 720), (1920, 1080)]
+SIZE_WEIGHTS = [4, 3, 2, 1]
+FORMATS = [('.jpg', 'JPEG'), ('.png', 'PNG')]
+
+ALBUM_KEY = 'bench'
+
+BENCHMARKS = ['combine_paths', 'is_duplicate', 'download_image', 'grab_images',
+              'album']
+
+#
+# corpus
+#
+
+def make_image(rng, width, height):
+    """Returns a random image. Images made this way all hash differently."""
+    from PIL import Image
+    small = Image.frombytes('RGB', (16, 12), rng.randbytes(16 * 12 * 3))
+    return small.resize((width, height), Image.BICUBIC)
+
+def make_corpus(count, seed=SEED):
+    """
+    Generates count images of mixed formats and sizes, unless they were
+    generated before, and returns the directory holding them along with a
+    list of their filenames.
+    """
+    directory = os.path.abspath(os.path.join(CORPUS_DIR, '%d-%d' % (count, seed)))
+    manifest = os.path.join(directory, 'corpus.json')
+    if os.path.isfile(manifest):
+        with open(manifest, 'r') as input:
+            return directory, json.load(input)
+
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+    rng = random.Random(seed)
+    filenames = []
+    for i in range(count):
+        width, height = rng.choices(SIZES, SIZE_WEIGHTS)[0]
+        ext, format = rng.choice(FORMATS)
+        filename = 'c%06d%s' % (i, ext)
+        make_image(rng, width, height).save(os.path.join(directory, filename),
+                                            format)
+        filenames.append(filename)
+
+    with open(manifest, 'w') as out:
+        json.dump(filenames, out)
+    return directory, filenames
+
+#
+# local stand-in for the image hosts
+#
+
+class LocalHandler(http.server.SimpleHTTPRequestHandler):
+    """Serves the corpus, and an album page listing the album's images."""
+    def do_GET(self):
+        started = time.perf_counter()
+        # requests arrive with the real host in front of the path
+        host, self.path = fakeserver.route(self.path)
+        path = urlsplit(self.path).path
+        if path == '/a/%s/layout/blog' % ALBUM_KEY:
+            self.send_album()
+        else:
+            super().do_GET()
+        self.server.record(time.perf_counter() - started)
+
+    def send_album(self):
+        images = ','.join('{"hash":"%s","title":"","ext":"%s"}'
+                          % os.path.splitext(name) for name in self.server.album)
+        body = ('<html><script>var album = {"images":[%s]};</script></html>'
+                % images).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def copyfile(self, source, outputfile):
+        count = 0
+        for block in iter(lambda: source.read(65536), b''):
+            outputfile.write(block)
+            count += len(block)
+        self.server.add_bytes(count)
+
+    def log_message(self, format, *args):
+        pass
+
+class LocalServer(http.server.ThreadingHTTPServer):
+    """Serves directory on a free local port and times every request."""
+    daemon_threads = True
+
+    def __init__(self, directory, album=()):
+        handler = lambda *args: LocalHandler(*args, directory=directory)
+        super().__init__(('127.0.0.1', 0), handler)
+        self.album = list(album)
+        self.latencies = []
+        self.bytes = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def base(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def record(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes += count
+
+def route_to(server):
+    """Sends every request made by the shared session to server."""
+    import httpclient
+    httpclient.configure(media_url=server.base)
+
+#
+# local stand-in for reddit
+#
+
+class LocalPost():
+    def __init__(self, id, url, score):
+        self.id = id
+        self.url = url
+        self.score = score
+        self.permalink = '/r/bench/comments/%s/' % id
+
+class LocalSubreddit():
+    def __init__(self, name, posts):
+        self.name = name
+        self.posts = posts
+
+    def __str__(self):
+        return self.name
+
+    def top(self, time_filter='day', limit=1):
+        return iter(self.posts[:limit])
+
+    def hot(self, limit=3):
+        return iter(self.posts[:limit])
+
+class LocalReddit():
+    """Hands out listings of posts in place of the praw client."""
+    def __init__(self, listings):
+        self.listings = listings
+
+    def subreddit(self, name):
+        return LocalSubreddit(name, self.listings.get(name, []))
+
+#
+# benchmarks
+#
+
+def make_dat(image_dir, **other):
+    import store
+    import loader
+    from data import Data
+    dat = Data()
+    dat.userdata['image_id'] = 0
+    dat.userdata['imgur_galleries'] = store.GallerySet(store.get_store())
+    dat.configdata = {
+        'path' : {'image' : image_dir},
+        'subreddits' : [],
+        'postsave' : 1,
+        'timing' : 3600,
+        'other' : {'ignore_duplicates' : 1, 'download_gallery' : 1},
+    }
+    dat.configdata['other'].update(other)
+    loader.fill_optional_settings(dat.configdata)
+    return dat
+
+def percentile(values, fraction):
+    """Returns the nearest-rank percentile of values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+def summarize(count, seconds, latencies, size=None, unit='posts'):
+    """Turns raw measurements into the reported metrics."""
+    metrics = {
+        unit + '_per_sec' : count / seconds if seconds else 0.0,
+        'p50_ms' : percentile(latencies, 0.50) * 1000,
+        'p99_ms' : percentile(latencies, 0.99) * 1000,
+        'seconds' : seconds,
+    }
+    if size is not None:
+        metrics['mb_per_sec'] = size / 1e6 / seconds if seconds else 0.0
+    return metrics
+
+def timed_calls(function, arguments):
+    """Calls function with each tuple of arguments and returns the latencies."""
+    latencies = []
+    for args in arguments:
+        started = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+def bench_combine_paths(corpus, filenames, args):
+    """Reserves paths for new images in a directory holding the corpus."""
+    import download
+    dat = make_dat(corpus)
+    calls = min(len(filenames), 10000)
+    started = time.perf_counter()
+    latencies = timed_calls(download.combine_paths, [(dat,)] * calls)
+    return summarize(calls, time.perf_counter() - started, latencies, unit='paths')
+
+def bench_is_duplicate(corpus, filenames, args):
+    """Indexes the corpus, then looks up a sample of its images."""
+    import download
+    import hashindex
+    started = time.perf_counter()
+    hashindex.get_index(corpus)
+    build = time.perf_counter() - started
+
+    sample = random.Random(SEED).sample(filenames, min(len(filenames), 500))
+    calls = [(os.path.join(corpus, name), corpus) for name in sample]
+    started = time.perf_counter()
+    latencies = timed_calls(download.is_duplicate, calls)
+    metrics = summarize(len(calls), time.perf_counter() - started, latencies,
+                        unit='images')
+    metrics['index_seconds'] = build
+    return metrics
+
+def bench_download_image(corpus, filenames, args):
+    """Downloads a sample of the corpus one image at a time."""
+    import download
+    server = LocalServer(corpus)
+    route_to(server)
+    image_dir = os.path.abspath('images')
+    os.makedirs(image_dir)
+    dat = make_dat(image_dir)
+
+    sample = filenames[:min(len(filenames), 200)]
+    calls = [(os.path.join(image_dir, name), 'https://i.redd.it/' + name, dat)
+             for name in sample]
+    started = time.perf_counter()
+    latencies = timed_calls(download.download_image, calls)
+    seconds = time.perf_counter() - started
+    return summarize(len(calls), seconds, latencies, server.bytes)
+
+def bench_grab_images(corpus, filenames, args):
+    """Runs the whole pipeline on listings that link to the corpus."""
+    import download
+    server = LocalServer(corpus)
+    route_to(server)
+    image_dir = os.path.abspath('images')
+    os.makedirs(image_dir)
+    dat = make_dat(image_dir)
+
+    posts = filenames[:min(len(filenames), args.posts)]
+    names = ['bench%d' % i for i in range(args.subreddits)]
+    listings = {name : [] for name in names}
+    for i, filename in enumerate(posts):
+        post = LocalPost('p%d' % i, 'https://i.redd.it/' + filename, len(posts) - i)
+        listings[names[i % len(names)]].append(post)
+    dat.configdata['subreddits'] = names
+    dat.configdata['endpoints']['media'] = server.base
+    dat.configdata['download']['posts_per_listing'] = \
+        max(len(listing) for listing in listings.values())
+
+    started = time.perf_counter()
+    results = download.grab_images(dat, LocalReddit(listings))
+    seconds = time.perf_counter() - started
+    metrics = summarize(len(results), seconds, server.latencies, server.bytes)
+    metrics['saved'] = results.count(download.NO_ERROR)
+    return metrics
+
+def bench_album(corpus, filenames, args):
+    """Saves a whole album whose images are part of the corpus."""
+    import httpclient
+    from imgur_album_downloader.imguralbum import ImgurAlbumDownloader
+    album = filenames[:min(len(filenames), args.album)]
+    server = LocalServer(corpus, album)
+    route_to(server)
+
+    started = time.perf_counter()
+    downloader = ImgurAlbumDownloader('https://imgur.com/a/' + ALBUM_KEY,
+                                      httpclient.get_session(),
+                                      httpclient.retrieve)
+    downloader.save(os.path.abspath('album'), workers=4)
+    seconds = time.perf_counter() - started
+    return summarize(downloader.num_images(), seconds, server.latencies,
+                     server.bytes, unit='images')
+
+def peak_rss_mb():
+    """Returns the peak resident set size of this process in MB, if known."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+def run_one(name, args):
+    """Runs a single benchmark in a scratch directory and returns its metrics."""
+    corpus, filenames = make_corpus(args.corpus)
+    scratch = tempfile.mkdtemp(prefix='bench-')
+    cwd = os.getcwd()
+    os.chdir(scratch)
+    try:
+        metrics = globals()['bench_' + name](corpus, filenames, args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return metrics
+
+#
+# baseline comparison
+#
+
+def is_worse(metric, value, baseline):
+    """Checks if value is worse than baseline by more than TOLERANCE."""
+    if value is None or not baseline:
+        return False
+    if metric.endswith('_per_sec'):
+        return value < baseline * (1 - TOLERANCE)
+    if metric.endswith(('_ms', '_mb', 'seconds')):
+        return value > baseline * (1 + TOLERANCE)
+    return False
+
+def compare(results, baseline):
+    """Prints every metric next to its baseline. Returns the regressions."""
+    regressions = []
+    for key, metrics in results.items():
+        print(key)
+        for metric, value in sorted(metrics.items()):
+            before = baseline.get(key, {}).get(metric)
+            line = '    %-16s %12s' % (metric, format_value(value))
+            if before is not None:
+                line += '   baseline %12s' % format_value(before)
+            if is_worse(metric, value, before):
+                line += '   REGRESSION'
+                regressions.append((key, metric))
+            print(line)
+    return regressions
+
+def format_value(value):
+    if isinstance(value, float):
+        return '%.2f' % value
+    return str(value)
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline pipeline benchmarks.')
+    parser.add_argument('benchmarks', nargs='*', default=BENCHMARKS,
+                        help='benchmarks to run: ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--corpus', type=int, default=500,
+                        help='number of images in the corpus')
+    parser.add_argument('--posts', type=int, default=200,
+                        help='number of posts in the grab_images listings')
+    parser.add_argument('--subreddits', type=int, default=8,
+                        help='number of subreddits the posts are spread over')
+    parser.add_argument('--album', type=int, default=100,
+                        help='number of images in the album')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # runs in a process of its own, so peak memory is measured per benchmark
+        print(json.dumps(run_one(args.benchmarks[0], args)))
+        return 0
+
+    make_corpus(args.corpus)
+    results = {}
+    for name in args.benchmarks:
+        command = [sys.executable, os.path.abspath(__file__), name, '--child'] + \
+                  ['--corpus', str(args.corpus), '--posts', str(args.posts),
+                   '--subreddits', str(args.subreddits), '--album', str(args.album)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                universal_newlines=True).stdout
+        results['%s@%d' % (name, args.corpus)] = json.loads(output.splitlines()[-1])
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, 'r') as input:
+            baseline = json.load(input)
+    regressions = compare(results, baseline)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as out:
+            json.dump(baseline, out, indent=4, sort_keys=True)
+    elif regressions:
+        print('%d metrics regressed by more than %d%%'
+              % (len(regressions), TOLERANCE * 100))
+        return 1
+    return 0
 
-import re
+if __name__ == '__main__':
+    sys.exit(main())